@@ -0,0 +1,171 @@
+"""
+End-to-end scaling benchmark for the sinterbot command line tool.
+
+For each size n a synthetic config (see makeconf.py) is written, then each
+subcommand is run against it in a separate process and its wall time and
+peak RSS are recorded. The parse -> validate -> derange -> save_derangement
+-> get_assignments phases are also timed one by one in a child process, to
+show which of them dominates.
+
+Example:
+
+    python benchcli.py -n 1000 10000 100000 -b 1e-5 -m 3 --json bench.json
+
+With -l the santas get random locations and the mincost engine is used.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import makeconf
+
+# Subcommands run against each config (the config path is appended)
+COMMANDS = [
+    ['check'],
+    ['view'],
+    ['export', '--format', 'ndjson', '--output', os.devnull],
+    ['derange', '--force'],
+]
+
+
+def run_command(args: List[str], timeout: float) -> Dict:
+    """
+    Run `python -m bin.sinterbot args...` and return its wall time (seconds),
+    peak RSS (KiB) and exit status, or timeout=True if it was killed.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'bin.sinterbot'] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if time.perf_counter() - start > timeout:
+            proc.kill()
+            os.wait4(proc.pid, 0)
+            return {'timeout': True, 'wall': timeout}
+        time.sleep(0.005)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'timeout': False,
+        'wall': time.perf_counter() - start,
+        'maxrss_kib': usage.ru_maxrss,
+        'returncode': proc.returncode,
+    }
+
+
+def phases(path: str):
+    """
+    Time each phase of deranging the config at path, printing one JSON line
+    per phase as soon as it finishes (so the parent keeps the phases that
+    completed if it has to kill us).
+    """
+    import sinterbot.sinterconf as config
+
+    def report(phase, start):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print(json.dumps({'phase': phase, 'time': time.perf_counter() - start,
+            'maxrss_kib': usage.ru_maxrss}), flush=True)
+
+    start = time.perf_counter()
+    c = config.SinterConf(path)
+    c.parse()
+    report('parse', start)
+
+    start = time.perf_counter()
+    c.validate()
+    report('validate', start)
+
+    start = time.perf_counter()
+    c.get_assignments()
+    report('get_assignments', start)
+
+    start = time.perf_counter()
+    c.derange()
+    report('derange', start)
+
+    start = time.perf_counter()
+    c.save_derangement()
+    report('save_derangement', start)
+
+
+def run_phases(path: str, timeout: float) -> Dict[str, Dict]:
+    """Run phases() in a child process and collect its results"""
+    proc = subprocess.Popen([sys.executable, __file__, '--phases', path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True)
+    try:
+        out, _ = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        out, _ = proc.communicate()
+    results = {}
+    for line in out.splitlines():
+        r = json.loads(line)
+        results[r.pop('phase')] = r
+    return results
+
+
+def fmt(result: Optional[Dict]) -> str:
+    if result is None:
+        return "%16s" % "-"
+    if result.get('timeout'):
+        return "%16s" % "timeout"
+    return "%8.3fs %5dMiB" % (result.get('wall', result.get('time')),
+            result['maxrss_kib'] // 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sinterbot subcommands on synthetic configs.')
+    parser.add_argument('-n', type=int, nargs='+', default=[1000, 10000, 100000], help='Config sizes (default: %(default)s)')
+    parser.add_argument('-b', '--density', type=float, default=1e-5, help='Fraction of pairs to blacklist (default: %(default)s)')
+    parser.add_argument('-m', '--mincycle', type=int, default=2, help='mincycle constraint (default: %(default)s)')
+    parser.add_argument('-l', '--locations', action='store_true', help='Give santas random locations and set mincost: true')
+    parser.add_argument('-t', '--timeout', type=float, default=120, help='Seconds before a command is killed (default: %(default)s)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--phases', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phases:
+        phases(args.phases)
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    phase_names = ['parse', 'validate', 'get_assignments', 'derange', 'save_derangement']
+    try:
+        for n in args.n:
+            path = os.path.join(tmpdir, 'bench%d.conf' % n)
+            makeconf.write_conf(path, n, args.density, args.mincycle,
+                    deranged=True, seed=n, mincost=args.locations)
+            result: Dict = {'n': n, 'commands': {}, 'phases': {}}
+            for cmd in COMMANDS:
+                copy = path + '.copy'
+                shutil.copy(path, copy)
+                result['commands'][cmd[0]] = run_command(cmd + [copy], args.timeout)
+            shutil.copy(path, path + '.copy')
+            result['phases'] = run_phases(path + '.copy', args.timeout)
+            results.append(result)
+
+            print("n = %d" % n)
+            for name, r in result['commands'].items():
+                print("  %-18s %s" % ("sinterbot " + name, fmt(r)))
+            for name in phase_names:
+                print("  %-18s %s" % (name, fmt(result['phases'].get(name))))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark drawing many constrained derangements with a DerangementSampler
+against the previous approach of calling generate_rejection() and
+check_constraints() until a draw is accepted. The previous approach is
+copied here as it was before DerangementSampler (and before the later
+changes to check_constraints() and check_min_cycles()), so the comparison
+is against the code that actually shipped.
+
+For each n the time per accepted sample, the number of shuffles and shuffle
+positions per sample (the sampler abandons a shuffle as soon as it breaks a
+constraint) and the peak memory traced while sampling are printed.
+
+Example:
+
+    python benchsampler.py -n 10 100 1000 10000 -m 3 -b 1e-4
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Set, Tuple
+
+import sinterbot.algorithms as algo
+
+
+def old_check_min_cycles(perm: List[int], m: int) -> bool:
+    """
+    check_min_cycles() as it was before DerangementSampler
+    """
+    if m < 2: return True
+
+    unvisited = list(perm) # copy input to mutable list
+
+    # Visit all cycles until we find one less than length m (or we visit them all)
+    while len(unvisited):
+        first = unvisited.pop(0)
+        nextval = perm[first]
+        cur = 1
+        while nextval != first:
+            cur += 1
+            unvisited.pop(unvisited.index(nextval))
+            nextval = perm[nextval]
+        if cur < m: return False
+    return True
+
+
+def old_check_constraints(perm: List[int], m: int, bl: algo.Blacklist) -> bool:
+    """
+    check_constraints() as it was before DerangementSampler
+    """
+    if m < 2: m = 2
+    if m == 2:
+        # faster
+        if not algo.check_deranged(perm):
+            return False
+    else:
+        # slower but can handle any m
+        if not old_check_min_cycles(perm, m):
+            return False
+    return algo.check_blacklist(perm, bl)
+
+
+def rejection(n: int, m: int, bl: algo.Blacklist, stats: Dict) -> List[int]:
+    """
+    constrained() as it was before DerangementSampler (with
+    generate_rejection() inlined to count its shuffles)
+    """
+    while True:
+        perm = list(range(n))
+        while not algo.check_deranged(perm):
+            stats['shuffles'] += 1
+            for i in range(n):
+                k = random.randrange(n-i)+i # i <= k < n
+                perm[i], perm[k] = perm[k], perm[i]
+        if old_check_constraints(perm, m, bl):
+            return perm
+
+
+def measure(draw: Callable[[], List[int]], samples: int) -> Dict:
+    """Time `samples` calls of draw, then trace the memory of a few more"""
+    start = time.perf_counter()
+    for i in range(samples):
+        draw()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for i in range(min(samples, 10)):
+        draw()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'us': elapsed / samples * 1e6, 'peak_kib': peak / 1024}
+
+
+def blacklist(n: int, density: float, rng: random.Random) -> algo.Blacklist:
+    pairs: Set[Tuple[int, int]] = set()
+    while len(pairs) < int(density * n * (n-1) / 2):
+        a, b = rng.randrange(n), rng.randrange(n)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    return sorted(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DerangementSampler against rejection sampling.')
+    parser.add_argument('-n', type=int, nargs='+', default=[10, 100, 1000, 10000], help='Numbers of santas (default: %(default)s)')
+    parser.add_argument('-m', '--mincycle', type=int, default=2, help='mincycle constraint (default: %(default)s)')
+    parser.add_argument('-b', '--density', type=float, default=0.0, help='Fraction of pairs to blacklist (default: %(default)s)')
+    parser.add_argument('-s', '--samples', type=int, help='Samples per n (default: about 10^6/n)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: %(default)s)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print("%8s %-8s %12s %10s %12s %10s" % ('n', 'method', 'us/sample',
+        'shuffles', 'positions', 'peak KiB'))
+    for n in args.n:
+        samples = args.samples or max(10, 10**6 // n)
+        bl = blacklist(n, args.density, rng)
+
+        drawn = samples + min(samples, 10)
+        stats = {'shuffles': 0}
+        result = measure(lambda: rejection(n, args.mincycle, bl, stats), samples)
+        print("%8d %-8s %12.1f %10.2f %12.0f %10.1f" % (n, 'old', result['us'],
+            stats['shuffles'] / drawn, stats['shuffles'] * n / drawn, result['peak_kib']))
+
+        sampler = algo.DerangementSampler(n, args.mincycle, bl)
+        result = measure(sampler.sample, samples)
+        print("%8d %-8s %12.1f %10.2f %12.0f %10.1f" % (n, 'sampler', result['us'],
+            sampler.shuffles / drawn, sampler.placed / drawn, result['peak_kib']))
+
+
+if __name__ == "__main__":
+    main()
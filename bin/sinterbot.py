@@ -2,80 +2,203 @@
 import argparse
 import logging
 import sys
-import sinterbot.sinterconf as config
-import sinterbot.smtpconf as smtpconfig
-from email.message import EmailMessage
-import textwrap
-import smtplib
-import datetime
+from typing import List, Tuple, Optional, TextIO, TYPE_CHECKING
+
+# Modules needed by only some of the subcommands are imported by the functions
+# that use them, so that quick commands like `check` and `view` do not pay to
+# import smtplib, email, etc. at startup.
+if TYPE_CHECKING:
+    import sinterbot.sinterconf as config
+
+# Result of processing one config file in a batch: (path, success, message)
+Result = Tuple[str, bool, str]
+
+# Seconds to wait for the SMTP server before giving up on a connection or
+# message (so a hung relay shows up in the send metrics instead of hanging)
+SMTP_TIMEOUT = 30
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print diagnostics, such as the MCMC sampler statistics, while running.')
     subparsers = parser.add_subparsers(dest='subcommand', required=True)
 
     # derange command
     derangeparser = subparsers.add_parser('derange', help='Read .config file and add derangement information to it.')
-    derangeparser.add_argument('path', help='Path to config file')
+    derangeparser.add_argument('path', nargs='+', help='Path to config file (or directory of *.conf files). May be given more than once.')
     derangeparser.add_argument('-f', '--force', help='Derange the config file even if it already contains assignment info.', action='store_true')
+    derangeparser.add_argument('-j', '--jobs', type=int, help='Number of worker processes to use when given several config files (default: number of CPUs).')
 
     # check command
-    viewparser = subparsers.add_parser('check', help='Check that the config file contains a valid derangement')
-    viewparser.add_argument('path', help='Path to config file')
+    checkparser = subparsers.add_parser('check', help='Check that the config file contains a valid derangement')
+    checkparser.add_argument('path', nargs='+', help='Path to config file (or directory of *.conf files). May be given more than once.')
+    checkparser.add_argument('-j', '--jobs', type=int, help='Number of worker processes to use when given several config files (default: number of CPUs).')
 
     # send command
     sendparser = subparsers.add_parser('send', help='Send every santa an email with the name of their assigned recipient.')
     sendparser.add_argument('-u', '--user', dest='email', help='Send the assignment email only to the given email address(es).', action='append')
     sendparser.add_argument('path', help='Path to config file')
     sendparser.add_argument('-c', dest='smtppath', required=True, help='Path to smtp.conf file')
+    sendparser.add_argument('--metrics-prom', help='Write delivery metrics to this file in the Prometheus text format.')
+    sendparser.add_argument('--metrics-json', help='Write a JSON summary of the delivery metrics to this file.')
 
     # view command
     viewparser = subparsers.add_parser('view', help='Show the list of secret santa assignments.')
     viewparser.add_argument('path', help='Path to config file')
     viewparser.add_argument('-u', '--user', dest='email', help='Show only the recipient assigned to the given email address(es).', action='append')
 
+    # export command
+    exportparser = subparsers.add_parser('export', help='Write the secret santa assignments as CSV or newline delimited JSON.')
+    exportparser.add_argument('path', help='Path to config file')
+    exportparser.add_argument('-f', '--format', choices=['csv', 'ndjson'], default='csv', help='Output format (default: %(default)s).')
+    exportparser.add_argument('-o', '--output', help='File to write (default: standard output).')
+    exportparser.add_argument('-u', '--user', dest='email', help='Export only the recipient assigned to the given email address(es).', action='append')
+
+    # serve command
+    serveparser = subparsers.add_parser('serve', help='Answer recipient lookups for the config file(s) over local HTTP or a Unix socket.')
+    serveparser.add_argument('path', nargs='+', help='Path to config file. May be given more than once.')
+    serveparser.add_argument('-p', '--port', type=int, default=8025, help='HTTP port to listen on (default: %(default)s).')
+    serveparser.add_argument('--host', default='127.0.0.1', help='HTTP address to listen on (default: %(default)s).')
+    serveparser.add_argument('-s', '--socket', help='Listen on a Unix socket at this path instead of HTTP.')
+
+    # audit command
+    auditparser = subparsers.add_parser('audit', help='Draw many random assignments for the config file and test that they are uniformly distributed.')
+    auditparser.add_argument('path', help='Path to config file')
+    auditparser.add_argument('-s', '--samples', type=int, default=100000, help='Number of assignments to draw (default: %(default)s).')
+    auditparser.add_argument('-j', '--jobs', type=int, help='Number of worker processes (default: number of CPUs).')
+    auditparser.add_argument('-e', '--engine', choices=['constrained', 'mcmc', 'chain'], help='Generator to audit (default: the one used by derange).')
+
     return parser.parse_args()
 
 
-def parse_config(path: str) -> config.SinterConf:
+def read_config(path: str) -> Tuple[Optional['config.SinterConf'], str]:
     """
-    Parse the config file at path. On failure log error and quit.
+    Parse and validate the config file at path. Returns the config and an
+    empty string on success, or None and an error message on failure.
     """
+    import sinterbot.sinterconf as config
     try:
         c = config.SinterConf.parse_and_validate(path)
     except FileNotFoundError:
-        logging.error("Could not find file at path: %s" % path)
-        sys.exit(1)
+        return None, "Could not find file at path: %s" % path
     except config.ValidateError as e:
-        logging.error(e)
-        sys.exit(1)
+        return None, str(e)
     except config.ParseError as e:
-        logging.error("Parse error on line %d" % e.line)
+        return None, "Parse error on line %d" % e.line
+    return c, ""
+
+
+def parse_config(path: str) -> 'config.SinterConf':
+    """
+    Parse the config file at path. On failure log error and quit.
+    """
+    c, err = read_config(path)
+    if c is None:
+        logging.error(err)
         sys.exit(1)
     return c
 
 
-def derange(args: argparse.Namespace):
-    path = args.path
-    c = parse_config(path)
-    if c.derangement:
-        if not args.force:
-            print("Input config (%s) already deranged. Pass the --force option if you'd like to modify it anyway." % path)
-            return
+def expand_paths(paths: List[str]) -> List[str]:
+    """
+    Replace each directory in paths with the *.conf files it contains.
+    Exits with an error if a directory contains none.
+    """
+    import pathlib
+    expanded = []
+    for path in paths:
+        p = pathlib.Path(path).expanduser()
+        if p.is_dir():
+            confs = sorted(str(f) for f in p.glob('*.conf'))
+            if not confs:
+                logging.error("No *.conf files found in directory %s" % path)
+                sys.exit(1)
+            expanded.extend(confs)
         else:
-            c.derange()
+            expanded.append(path)
+    return expanded
+
+
+def run_one(func, path: str, *args) -> Result:
+    """
+    Call func(path, *args), turning any unexpected exception into a failed
+    result so that one bad file does not abort the rest of a batch.
+    """
+    try:
+        return func(path, *args)
+    except Exception as e:
+        return path, False, "%s: %s" % (type(e).__name__, e)
+
+
+def run_batch(func, paths: List[str], jobs: Optional[int], *args) -> List[Result]:
+    """
+    Call func(path, *args) for every path and return the list of results.
+    Several paths are processed in a pool of worker processes (the size of
+    which is given by the --jobs option).
+    """
+    if len(paths) == 1:
+        return [run_one(func, paths[0], *args)]
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(run_one, [func]*len(paths), paths,
+            *[[a]*len(paths) for a in args]))
+
+
+def report(results: List[Result]):
+    """
+    Print the outcome of a (batch) command and exit non-zero if any file
+    failed. A single file is reported just by its message.
+    """
+    failed = [r for r in results if not r[1]]
+    if len(results) == 1:
+        path, ok, msg = results[0]
+        if ok:
+            print(msg)
+        else:
+            logging.error(msg)
+    else:
+        for path, ok, msg in results:
+            print("%s: %s %s" % (path, "OK  " if ok else "FAIL", msg.splitlines()[0]))
+        print("%d file(s) processed, %d failed." % (len(results), len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+def derange_one(path: str, force: bool) -> Result:
+    import sinterbot.sinterconf as config
+    c, err = read_config(path)
+    if c is None:
+        return path, False, err
+    if c.derangement and not force:
+        return path, True, "Input config (%s) already deranged. Pass the --force option if you'd like to modify it anyway." % path
+    try:
+        c.derange()
+    except config.ValidateError as e:
+        # leave the file as it was
+        return path, False, str(e)
     c.save_derangement()
-    print("Derangement info successfully added to config file.\nUse `sinterbot send %s -c smtp.conf` to send emails!" % path)
+    return path, True, "Derangement info successfully added to config file.\nUse `sinterbot send %s -c smtp.conf` to send emails!" % path
 
 
-def check(args: argparse.Namespace):
-    path = args.path
-    c = parse_config(path)
+def derange(args: argparse.Namespace):
+    paths = expand_paths(args.path)
+    report(run_batch(derange_one, paths, args.jobs, args.force))
+
+
+def check_one(path: str) -> Result:
+    c, err = read_config(path)
+    if c is None:
+        return path, False, err
     if c.derangement:
-        print("Valid derangement found.")
+        return path, True, "Valid derangement found."
     else:
-        print("Config file does not contain derangement. Try running `sinterbot derange %s" % path)
-    return
+        return path, True, "Config file does not contain derangement. Try running `sinterbot derange %s" % path
+
+
+def check(args: argparse.Namespace):
+    paths = expand_paths(args.path)
+    report(run_batch(check_one, paths, args.jobs))
 
 
 def view(args: argparse.Namespace):
@@ -85,26 +208,87 @@ def view(args: argparse.Namespace):
         print("No derangement found in config file. First run `sinterbot derange %s`" % path)
         return
     if args.email:
-        emails = args.email
+        emails = set(args.email)
     else:
-        emails = c.santas.emails()
-    secrets = c.get_assignments()
+        emails = set(c.santas.emails())
+    secrets = c.get_all_assignments()
     santas = secrets.items()
     # Find longest santa
     max_len = 0
-    for santa, recip in santas:
+    for santa, recips in santas:
         l = len(santa.name) + len(santa.email)
         if l > max_len: max_len = l
     print("{:^{max_len}}  ->   {:^{max_len}}".format("Santa", "Recipient", max_len=max_len+3))
-    for santa, recip in santas:
+    for santa, recips in santas:
         if santa.email not in emails: continue
         santaf = "{} <{}>".format(santa.name, santa.email)
-        recipf = "{} <{}>".format(recip.name, recip.email)
-        print("{:<{max_len}}  ->   {:<{max_len}}".format(santaf, recipf, max_len=max_len+3))
+        for recip in recips:
+            recipf = "{} <{}>".format(recip.name, recip.email)
+            print("{:<{max_len}}  ->   {:<{max_len}}".format(santaf, recipf, max_len=max_len+3))
     return
 
 
+def export(args: argparse.Namespace):
+    import csv
+    import json
+
+    path = args.path
+    c = parse_config(path)
+    if not c.derangement:
+        logging.error("No derangement found in config file. First run `sinterbot derange %s`" % path)
+        sys.exit(1)
+    emails = set(args.email) if args.email else None
+
+    # Assignments are written one at a time as they are generated
+    out: TextIO
+    if args.output:
+        out = open(args.output, 'w', newline='', buffering=2**16)
+    else:
+        out = sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['santa_name', 'santa_email', 'recipient_name', 'recipient_email'])
+        for santa, recip in c.iter_assignments():
+            if emails is not None and santa.email not in emails: continue
+            if args.format == 'csv':
+                writer.writerow([santa.name, santa.email, recip.name, recip.email])
+            else:
+                out.write(json.dumps({'santa_name': santa.name,
+                    'santa_email': santa.email, 'recipient_name': recip.name,
+                    'recipient_email': recip.email}) + "\n")
+    finally:
+        if args.output:
+            out.close()
+        else:
+            out.flush()
+
+
+def smtp_connect(smtp, metrics):
+    """
+    Connect and log in to the SMTP server described by smtp (an SMTPConf),
+    timing each step into metrics (a SendMetrics).
+    """
+    import smtplib
+    with metrics.phase('connect'):
+        server = smtplib.SMTP(smtp.server, port=smtp.port, timeout=SMTP_TIMEOUT)
+    with metrics.phase('starttls'):
+        server.starttls()
+    with metrics.phase('login'):
+        server.login(smtp.user, smtp.password or "")
+    return server
+
+
 def send(args: argparse.Namespace):
+    import sinterbot.sinterconf as config
+    import sinterbot.smtpconf as smtpconfig
+    from email.message import EmailMessage
+    import textwrap
+    import smtplib
+    import datetime
+    import time
+    from sinterbot.metrics import SendMetrics, reply_code
+
     path = args.path
     smtp_path = args.smtppath
     c = parse_config(path)
@@ -115,33 +299,46 @@ def send(args: argparse.Namespace):
     try:
         smtp.parse()
     except FileNotFoundError:
-        logging.error("Could not find file at path: %s" % path)
+        logging.error("Could not find file at path: %s" % smtp_path)
         sys.exit(1)
     except config.ValidateError as e:
         logging.error(e)
         sys.exit(1)
-    except config.ParseError as e:
+    except smtpconfig.ParseError as e:
         logging.error("Parse error on line %d" % e.line)
         sys.exit(1)
 
     # send emails
     year = datetime.datetime.now().year
-    server = smtplib.SMTP(smtp.server, port=smtp.port)
-    server.starttls()
+    metrics = SendMetrics()
+
+    def write_metrics():
+        metrics.finish()
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+
     try:
-        if not smtp.password: smtp.password = ""
-        server.login(smtp.user, smtp.password)
+        server = smtp_connect(smtp, metrics)
     except smtplib.SMTPException as e:
         logging.error("Error logging in. Check your SMTP credentials in {}. Error: {}".format(smtp_path, e))
+        # the connection timings show where the login went wrong
+        write_metrics()
+        return
+    except OSError as e:
+        # connection refused, timeouts, DNS failures, ...
+        logging.error("Error connecting to SMTP server {}:{}. Error: {}".format(smtp.server, smtp.port, e))
+        write_metrics()
         return
     #server.set_debuglevel(1)
-    assignments = c.get_assignments()
+    assignments = c.get_all_assignments()
     if args.email:
         emails = args.email
     else:
         emails = c.santas.emails()
 
-    for santa, recipient in assignments.items():
+    for santa, recipients in assignments.items():
         if santa.email not in emails: continue  # handle -u flags
         email = EmailMessage()
         email['Subject'] = "Your {} Secret Santa Assignment".format(year)
@@ -157,24 +354,84 @@ def send(args: argparse.Namespace):
         --
         Sinterbot2020 🎁
         https://github.com/cristoper/sinterbot/
-        """.format(santa.name, recipient.name)
+        """.format(santa.name, "\n        ".join(r.name for r in recipients))
         email.set_content(textwrap.dedent(msg))
 
+        start = time.perf_counter()
         try:
             server.send_message(email, from_addr=smtp.email, to_addrs=santa.email)
+            # send_message raises unless the server accepted the message
+            # with a 250 reply
+            metrics.message(time.perf_counter() - start, 250)
             print("Sent message to {}!".format(santa.email))
-        except smtplib.SMTPException as e:
+        except OSError as e:
+            # smtplib.SMTPException or a socket error (such as a timeout)
+            metrics.message(time.perf_counter() - start, reply_code(e), ok=False)
             logging.error("There was an SMTP error while attempting to send the email to {}. Error: {}".format(santa.email, e))
             pass
-    server.quit()
+    try:
+        with metrics.phase('quit'):
+            server.quit()
+    except OSError:
+        pass
+    write_metrics()
+    print("Sent {} message(s) in {:.1f}s ({:.1f}/s), {} failed.".format(
+        metrics.sent, metrics.elapsed, metrics.rate, metrics.failed))
+
+
+def serve(args: argparse.Namespace):
+    import sinterbot.serve as serving
+    for path in args.path:
+        parse_config(path)  # fail early on a bad config
+    try:
+        serving.serve(args.path, args.host, args.port, args.socket)
+    except OSError as e:
+        logging.error(e)
+        sys.exit(1)
+
+
+def audit(args: argparse.Namespace):
+    try:
+        import sinterbot.audit as auditing
+    except ImportError as e:
+        logging.error("The audit command requires numpy (pip install sinterbot[audit]): %s" % e)
+        sys.exit(1)
+    c = parse_config(args.path)
+    engine = args.engine or c.engine()
+    if engine == 'disjoint' or c.sharded:
+        logging.error("The audit command does not support sharded configs or more than one gift per santa")
+        sys.exit(1)
+    if engine == 'mincost':
+        # mincost assignments are deliberately not uniform
+        logging.error("The audit command does not support mincost configs")
+        sys.exit(1)
+
+    def progress(result):
+        print("%d/%d samples drawn" % (result.total, args.samples), end='\r', file=sys.stderr)
+
+    result = auditing.run(len(c.santas), c.mincycle, c.bl_to_numeric(),
+            args.samples, engine, args.jobs, progress=progress)
+    print(file=sys.stderr)
+    print(result.report())
+
+
+# Function implementing each subcommand
+COMMANDS = {
+    'derange': derange,
+    'check': check,
+    'send': send,
+    'view': view,
+    'audit': audit,
+    'serve': serve,
+    'export': export,
+}
 
 
 def main():
     args = parse_args()
-
-    # Use a little introspection to dispatch subcommands directly to functions
-    method = getattr(sys.modules[__name__], args.subcommand)
-    method(args)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    COMMANDS[args.subcommand](args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+"""
+Load test for `sinterbot serve`. Several client threads look up random
+santas from a config file as fast as they can for a fixed time, then the
+request rate and latency percentiles are printed.
+
+Example (in one terminal):
+
+    sinterbot serve xmas.conf -p 8025
+
+and in another:
+
+    python loadtest.py xmas.conf -p 8025 -c 8 -d 10
+"""
+import argparse
+import http.client
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from typing import List
+
+import sinterbot.sinterconf as config
+
+
+def http_client(host: str, port: int, emails: List[str], deadline: float,
+        latencies: List[float], errors: List[int]):
+    conn = http.client.HTTPConnection(host, port)
+    while time.monotonic() < deadline:
+        email = random.choice(emails)
+        start = time.perf_counter()
+        conn.request('GET', '/lookup?email=' + urllib.parse.quote(email))
+        response = conn.getresponse()
+        body = response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200 or not json.loads(body)['assignments']:
+            errors.append(response.status)
+    conn.close()
+
+
+def socket_client(path: str, emails: List[str], deadline: float,
+        latencies: List[float], errors: List[int]):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    f = sock.makefile('rwb')
+    while time.monotonic() < deadline:
+        email = random.choice(emails)
+        start = time.perf_counter()
+        f.write(email.encode() + b"\n")
+        f.flush()
+        answer = json.loads(f.readline())
+        latencies.append(time.perf_counter() - start)
+        if not answer['assignments']:
+            errors.append(404)
+    sock.close()
+
+
+def percentile(sorted_data: List[float], p: float) -> float:
+    return sorted_data[min(len(sorted_data)-1, int(p/100 * len(sorted_data)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running `sinterbot serve`.')
+    parser.add_argument('path', help='Config file being served (to pick santas from)')
+    parser.add_argument('-p', '--port', type=int, default=8025, help='HTTP port (default: %(default)s)')
+    parser.add_argument('--host', default='127.0.0.1', help='HTTP address (default: %(default)s)')
+    parser.add_argument('-s', '--socket', help='Use the Unix socket at this path instead of HTTP')
+    parser.add_argument('-c', '--clients', type=int, default=4, help='Concurrent clients (default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds to run (default: %(default)s)')
+    args = parser.parse_args()
+
+    c = config.SinterConf(args.path)
+    c.parse()
+    emails = c.santas.emails()
+
+    deadline = time.monotonic() + args.duration
+    latencies: List[List[float]] = [[] for i in range(args.clients)]
+    errors: List[int] = []
+    threads = []
+    for i in range(args.clients):
+        if args.socket:
+            t = threading.Thread(target=socket_client, args=(args.socket,
+                emails, deadline, latencies[i], errors))
+        else:
+            t = threading.Thread(target=http_client, args=(args.host,
+                args.port, emails, deadline, latencies[i], errors))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    all_latencies = sorted(l for client in latencies for l in client)
+    if not all_latencies:
+        print("No requests completed")
+        return
+    print("Requests: %d (%d errors)" % (len(all_latencies), len(errors)))
+    print("Throughput: %.0f requests/s" % (len(all_latencies) / args.duration))
+    for p in [50, 90, 99, 99.9]:
+        print("p%-5g %.3f ms" % (p, percentile(all_latencies, p) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Write a synthetic sinterbot config file for testing and benchmarking.
+
+Example (100000 santas, each pair blacklisted with probability 1e-5, with a
+valid derangement already saved):
+
+    python makeconf.py big.conf -n 100000 -b 1e-5 -m 3 --deranged
+"""
+import argparse
+import random
+from typing import List, Optional
+
+
+def write_conf(path: str, n: int, density: float = 0.0, mincycle: int = 2,
+        deranged: bool = False, chain: bool = False, seed: Optional[int] = None,
+        mincost: bool = False):
+    """
+    Write a config file with n santas to path.
+
+    About density*n*(n-1)/2 random pairs of santas are blacklisted. If
+    deranged is True a valid derangement is appended; it is a single random
+    cycle (so it satisfies any mincycle) and the blacklist is chosen to avoid
+    it. If mincost is True every santa gets a random location in Europe and
+    mincost is set.
+    """
+    rng = random.Random(seed)
+
+    # A single cycle satisfies every mincycle constraint
+    perm: List[int] = list(range(n))
+    for i in range(n-1, 0, -1):
+        k = rng.randrange(i)
+        perm[i], perm[k] = perm[k], perm[i]
+
+    with open(path, 'w') as f:
+        f.write("# Synthetic config: %d santas, blacklist density %g\n" % (n, density))
+        for i in range(n):
+            if mincost:
+                f.write("Santa %d: user%d@email.tld, loc=%.4f/%.4f\n" % (i, i,
+                    rng.uniform(36, 60), rng.uniform(-10, 30)))
+            else:
+                f.write("Santa %d: user%d@email.tld\n" % (i, i))
+        if mincycle > 2:
+            f.write("mincycle: %d\n" % mincycle)
+        if chain:
+            f.write("chain: true\n")
+        if mincost:
+            f.write("mincost: true\n")
+
+        pairs = set()
+        count = int(density * n * (n-1) / 2)
+        while len(pairs) < count:
+            a, b = rng.randrange(n), rng.randrange(n)
+            if a == b or perm[a] == b or perm[b] == a:
+                continue
+            pair = (min(a, b), max(a, b))
+            if pair in pairs:
+                continue
+            pairs.add(pair)
+            f.write("!: user%d@email.tld, user%d@email.tld\n" % pair)
+
+        if deranged:
+            f.write("derangement:%s" % repr(perm))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic sinterbot config file.')
+    parser.add_argument('path', help='Path of config file to write')
+    parser.add_argument('-n', type=int, default=1000, help='Number of santas (default: %(default)s)')
+    parser.add_argument('-b', '--density', type=float, default=0.0, help='Fraction of pairs to blacklist (default: %(default)s)')
+    parser.add_argument('-m', '--mincycle', type=int, default=2, help='mincycle constraint (default: %(default)s)')
+    parser.add_argument('-d', '--deranged', action='store_true', help='Include a valid derangement')
+    parser.add_argument('-c', '--chain', action='store_true', help='Set chain: true')
+    parser.add_argument('-s', '--seed', type=int, help='Random seed')
+    parser.add_argument('-l', '--locations', action='store_true', help='Give santas random locations and set mincost: true')
+    args = parser.parse_args()
+    write_conf(args.path, args.n, args.density, args.mincycle, args.deranged,
+            args.chain, args.seed, args.locations)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ setuptools.setup(
                 'Programming Language :: Python :: 3.5',
                 ],
         extras_require={
-                'dev': ['mypy']
+                'dev': ['mypy'],
+                'audit': ['numpy'],
                 },
         )
@@ -1,8 +1,10 @@
 import random
 import math
 import itertools
-from decimal import Decimal
-from typing import Optional, List, Tuple, Iterator
+import collections
+import heapq
+from array import array
+from typing import Optional, List, Tuple, Iterator, Set, Dict, Sequence, Iterable, Callable, Deque
 
 """From random documentation:
 
@@ -15,21 +17,112 @@ MT has a period length of 2^19937 - 1, which means it can be used to uniformly s
 """    
 
 # For the typechecker
-Permutation = List[int]
+PermLike = Sequence[int]    # a Permutation or a list of ints
 Blacklist = List[Tuple[int, int]]
+Edges = Set[Tuple[int, int]]
 
-def Dn(n: int):
+class Permutation:
+    """
+    An immutable permutation of [n] (element i is mapped to perm[i]), stored
+    in a compact array of unsigned ints instead of a list of int objects.
+
+    The constructor checks in O(n) that the values are a bijection and
+    raises ValueError if they are not. The inverse, the cycle decomposition
+    and the length of the shortest cycle are computed the first time they
+    are asked for and then cached.
+
+    A Permutation can be indexed, iterated and compared like a list of ints,
+    so it can be passed to any of the functions in this module.
+    """
+    __slots__ = ('_values', '_inverse', '_cycles', '_min_cycle')
+
+    def __init__(self, values: Iterable[int] = ()):
+        try:
+            self._values = array('I', values)
+        except (OverflowError, TypeError):
+            raise ValueError("Not a permutation: %r" % (values,))
+        n = len(self._values)
+        seen = bytearray(n)
+        for v in self._values:
+            if v >= n or seen[v]:
+                raise ValueError("Not a permutation: %r" % (values,))
+            seen[v] = 1
+        self._inverse: Optional[Permutation] = None
+        self._cycles: Optional[List[List[int]]] = None
+        self._min_cycle: Optional[int] = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._values[key].tolist()
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Permutation):
+            return self._values == other._values
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self._values, other))
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(self._values.tobytes())
+
+    def __repr__(self):
+        # the same as the list repr, which is how derangements are saved
+        return repr(self._values.tolist())
+
+    def __reduce__(self):
+        return (Permutation, (self._values,))
+
+    def tolist(self) -> List[int]:
+        return self._values.tolist()
+
+    def inverse(self) -> 'Permutation':
+        """Returns the inverse permutation (recipient -> giver)"""
+        if self._inverse is None:
+            inv = array('I', [0]) * len(self._values)
+            for i, v in enumerate(self._values):
+                inv[v] = i
+            p = Permutation.__new__(Permutation)
+            p._values, p._inverse, p._cycles, p._min_cycle = inv, self, None, None
+            self._inverse = p
+        return self._inverse
+
+    def cycles(self) -> List[List[int]]:
+        """Returns the cycle decomposition (see decompose())"""
+        if self._cycles is None:
+            self._cycles = decompose(self._values)
+            self._min_cycle = min((len(c) for c in self._cycles), default=0)
+        return self._cycles
+
+    def min_cycle(self) -> int:
+        """Returns the length of the shortest cycle (0 if empty)"""
+        if self._min_cycle is None:
+            self._min_cycle = min_cycle(self._values)
+        return self._min_cycle
+
+# Table of subfactorials D_0, D_1, ... built up by Dn() as needed
+_subfactorials: List[int] = [1, 0]
+
+def Dn(n: int) -> int:
     """
     Calculate the subfactorial of n
     This is the same as the number of derangements that can be made from a set of size n
     """
-    # Use Decimal to handle large n accurately (by large, I mean n>13 or so)
-    s = 0
-    for k in range(n+1):
-        s += (-1)**k/Decimal(math.factorial(k))
-    return Decimal.to_integral_exact(Decimal(math.factorial(n)) * s)
+    # Use the recurrence D_n = (n-1)(D_{n-1} + D_{n-2}) with exact integers
+    # and remember every value computed so far.
+    table = _subfactorials
+    for k in range(len(table), n+1):
+        table.append((k-1) * (table[k-1] + table[k-2]))
+    return table[n]
 
-def decompose(perm: Permutation) -> List[Optional[List[int]]]:
+def decompose(perm: PermLike) -> List[List[int]]:
     """
     decompose traverses `perm` to decompose it into its cycles. Returns a list
     containing a list for each cycle where the elements of the list are in
@@ -41,50 +134,61 @@ def decompose(perm: Permutation) -> List[Optional[List[int]]]:
     > [[4, 2, 0], [3, 1]]
     """
 
-    cycles: List[Optional[List[int]]] = []
-    unvisited = list(perm) # copy input to mutable list
+    cycles: List[List[int]] = []
+    visited = bytearray(len(perm))
 
     # Begin at the first unvisited element of the input permutation,
     # following its index to the next element until we get back to the
-    # first to complete the cycle and append it to `cycles`. Each time an
-    # element in `perm` is visited, remove it from `unvisited`. Once
-    # `unvisited` is empty, we've visited every element and have all the
-    # cycles.
-    while len(unvisited):
-        first = unvisited.pop(0)
+    # first to complete the cycle and append it to `cycles`. Each element is
+    # marked in `visited` as it is added to a cycle, so every element is
+    # looked at a constant number of times.
+    for first in perm:
+        if visited[first]: continue
+        visited[first] = 1
         cur = [first]
         nextval = perm[first]
         while nextval != first:
             cur.append(nextval)
-            unvisited.pop(unvisited.index(nextval)) # remove from unvisited list
+            visited[nextval] = 1
             nextval = perm[nextval]
         cycles.append(cur)
 
     return cycles
 
 
-def check_min_cycles(perm: Permutation, m: int) -> bool:
+def min_cycle(perm: PermLike) -> int:
     """
-    Returns true if perm does not contain any cycles of length less than m (so
-    when m=2, returns true only for derangements)
+    Returns the length of the shortest cycle in perm (0 if perm is empty).
     """
-    if m < 2: return True
-
-    unvisited = list(perm) # copy input to mutable list
-
-    # Visit all cycles until we find one less than length m (or we visit them all)
-    while len(unvisited):
-        first = unvisited.pop(0)
+    n = len(perm)
+    shortest = n
+    visited = bytearray(n)
+    for first in range(n):
+        if visited[first]: continue
+        visited[first] = 1
         nextval = perm[first]
         cur = 1
         while nextval != first:
             cur += 1
-            unvisited.pop(unvisited.index(nextval))
+            visited[nextval] = 1
             nextval = perm[nextval]
-        if cur < m: return False
-    return True
+        if cur < shortest:
+            shortest = cur
+            if shortest == 1: break
+    return shortest
+
+
+def check_min_cycles(perm: PermLike, m: int) -> bool:
+    """
+    Returns true if perm does not contain any cycles of length less than m (so
+    when m=2, returns true only for derangements)
+    """
+    if m < 2: return True
+    if isinstance(perm, Permutation):
+        return perm.min_cycle() >= m
+    return min_cycle(perm) >= m
 
-def check_blacklist(perm: Permutation, bl: Optional[Blacklist]) -> bool:
+def check_blacklist(perm: PermLike, bl: Optional[Blacklist]) -> bool:
     """
     Returns true if perm does not contain any cycles where the pairs in bl follow each other.
     """
@@ -97,7 +201,22 @@ def check_blacklist(perm: Permutation, bl: Optional[Blacklist]) -> bool:
 
     return True
 
-def check_deranged(perm: Permutation) -> bool:
+def check_single_cycle(perm: PermLike) -> bool:
+    """
+    Returns True if perm consists of exactly one cycle containing every
+    element (so 0 -> perm[0] -> ... visits all of [n] before returning to 0).
+    """
+    n = len(perm)
+    if isinstance(perm, Permutation):
+        return n > 0 and perm.min_cycle() == n
+    cur = 0
+    for length in range(1, n+1):
+        cur = perm[cur]
+        if cur == 0:
+            return length == n
+    return False
+
+def check_deranged(perm: PermLike) -> bool:
     """
     Returns True if perm is deranged. Faster than check_min_cycles when m=2.
     """
@@ -105,9 +224,32 @@ def check_deranged(perm: Permutation) -> bool:
         if el == i: return False
     return True
 
-def check_constraints(perm: Permutation, m: int, bl: Optional[Blacklist]) -> bool:
+def check_constraints(perm: PermLike, m: int, bl: Optional[Blacklist],
+        groups: Optional[Sequence] = None) -> bool:
+    """
+    Returns True if perm satisfies the mincycle constraint m and the
+    blacklist bl. If groups is given (a group label for each element) perm
+    must also only assign elements within their own group.
+
+    Raises ValueError if perm is not a permutation of [n].
+    """
+    if not isinstance(perm, Permutation):
+        # check that perm is a bijection in place
+        n = len(perm)
+        seen = bytearray(n)
+        for el in perm:
+            if not 0 <= el < n or seen[el]:
+                raise ValueError("Not a permutation: %r" % (perm,))
+            seen[el] = 1
     if m < 2: m = 2
-    if m == 2:
+    if groups is not None:
+        # check for fixed points and the group of every element in one pass
+        for i, el in enumerate(perm):
+            if el == i or groups[el] != groups[i]:
+                return False
+        if m > 2 and not check_min_cycles(perm, m):
+            return False
+    elif m == 2:
         # faster
         if not check_deranged(perm):
             return False
@@ -117,7 +259,33 @@ def check_constraints(perm: Permutation, m: int, bl: Optional[Blacklist]) -> boo
             return False
     return check_blacklist(perm, bl)
 
-def all_derangements(n: int) -> Iterator[Permutation]:
+def check_forbidden(perm: PermLike, forbidden: Edges) -> bool:
+    """
+    Returns True if perm assigns no giver to a recipient in one of the
+    (giver, recipient) pairs in forbidden.
+    """
+    if len(forbidden) < len(perm):
+        for a, b in forbidden:
+            if perm[a] == b: return False
+        return True
+    for i, el in enumerate(perm):
+        if (i, el) in forbidden: return False
+    return True
+
+def forbidden_edges(bl: Optional[Blacklist]) -> Edges:
+    """
+    Returns the set of (giver, recipient) pairs ruled out by bl. Blacklist
+    pairs apply in both directions.
+    """
+    edges: Edges = set()
+    if bl is None:
+        return edges
+    for a, b in bl:
+        edges.add((a, b))
+        edges.add((b, a))
+    return edges
+
+def all_derangements(n: int) -> Iterator[List[int]]:
     """
     Generator that yields all derangements of size n.
     """
@@ -126,7 +294,7 @@ def all_derangements(n: int) -> Iterator[Permutation]:
         plist = list(p)
         if check_deranged(plist): yield(plist)
             
-def generate_backtrack(n: int) -> Permutation:
+def generate_backtrack(n: int) -> List[int]:
     """
     Generate a random derangement by backtracking. THIS IS BIASED.
     """
@@ -149,7 +317,7 @@ def generate_backtrack(n: int) -> Permutation:
             remaining.remove(perm[-1])
     return perm
 
-def generate_all(n: int) -> Permutation:
+def generate_all(n: int) -> List[int]:
     """
     Generates all possible permutations saving the derangements, and then
     returns a random derangement. SLOW AND MEMORY HOG.
@@ -162,7 +330,7 @@ def generate_all(n: int) -> Permutation:
             potential.append(plist)
     return random.choice(potential)
 
-def generate_rejection(n: int) -> Permutation:
+def generate_rejection(n: int) -> List[int]:
     """
     Create a random derangement of [n] by first generating a random permutation
     and rejecting it if it is not a derangement.
@@ -175,7 +343,7 @@ def generate_rejection(n: int) -> Permutation:
             perm[i], perm[k] = perm[k], perm[i]
     return perm
 
-def rand_derangement(n: int) -> Permutation:
+def rand_derangement(n: int) -> List[int]:
     """
     Directly generate a random derangement with uniform probability.
     """
@@ -204,15 +372,728 @@ def rand_derangement(n: int) -> Permutation:
             remaining.pop(rand_i)
     return perm
 
-def constrained(n: int, m: int = 2, bl: Blacklist = None) -> Permutation:
+class DerangementSampler:
+    """
+    Draws uniformly random derangements of [n] which satisfy the mincycle
+    constraint m and the blacklist bl (or a set of forbidden (giver,
+    recipient) pairs) by rejection sampling, like constrained() but faster
+    when many samples are needed.
+
+    The constraints are compiled once into a table of forbidden recipients
+    for each giver, and the permutation and the cycle check use scratch
+    buffers which are kept between draws. Each draw is a Fisher-Yates
+    shuffle which fixes one position at a time, so it is abandoned as soon
+    as a fixed point, a forbidden pair or (when m > 2) a 2-cycle is placed
+    instead of after the whole shuffle. Shuffling any permutation gives a
+    uniformly random permutation, so the buffer is not reset between
+    shuffles, and since an abandoned shuffle would have been rejected
+    anyway the accepted samples are still uniform.
+
+    Example:
+
+        sampler = DerangementSampler(100, 3, [(0, 1)])
+        for perm in itertools.islice(sampler.samples(), 1000):
+            ...
+    """
+    def __init__(self, n: int, m: int = 2, bl: Blacklist = None,
+            rng: random.Random = None, forbidden: Edges = None):
+        self.n = n
+        self.m = max(m, 2)
+        # draw from the random module's shared generator unless given one
+        self._random = rng.random if rng is not None else random.random
+        # banned[i] is the set of recipients giver i may not have (or None)
+        self._banned: List[Optional[Set[int]]] = [None] * n
+        for a, b in forbidden_edges(bl) | (forbidden or set()):
+            if self._banned[a] is None:
+                self._banned[a] = set()
+            self._banned[a].add(b)   # type:ignore
+        self._perm = list(range(n))
+        self._mark = [0] * n    # cycle check stamps (see _cycles_ok())
+        self._stamp = 0
+        self.shuffles = 0       # shuffles started
+        self.placed = 0         # positions placed over all shuffles
+
+    def _shuffle(self) -> bool:
+        """
+        Shuffle the buffer, returning False as soon as a position breaks a
+        constraint.
+        """
+        perm, banned, n = self._perm, self._banned, self.n
+        short = self.m > 2
+        random = self._random
+        self.shuffles += 1
+        for i in range(n):
+            # int(random() * k) is how random.shuffle picked indices before
+            # Python 3.11: its bias is far below anything measurable
+            k = i + int(random() * (n-i))
+            v = perm[k]
+            perm[k] = perm[i]
+            perm[i] = v
+            bad = banned[i]
+            if v == i or (bad is not None and v in bad) or (short and v < i and perm[v] == i):
+                self.placed += i+1
+                return False
+        self.placed += n
+        return True
+
+    def _cycles_ok(self) -> bool:
+        """Returns True if the buffer has no cycle shorter than m"""
+        perm, mark, m = self._perm, self._mark, self.m
+        # marking with a new stamp each time means mark never needs clearing
+        self._stamp += 1
+        stamp = self._stamp
+        for first in range(self.n):
+            if mark[first] == stamp: continue
+            mark[first] = stamp
+            length = 1
+            cur = perm[first]
+            while cur != first:
+                mark[cur] = stamp
+                length += 1
+                cur = perm[cur]
+            if length < m:
+                return False
+        return True
+
+    def sample(self, tries: int = None) -> List[int]:
+        """
+        Returns a new random derangement satisfying the constraints, or []
+        if none was found in `tries` shuffles (by default keep trying).
+        """
+        if self.m > self.n: return []
+        attempt = 0
+        while tries is None or attempt < tries:
+            attempt += 1
+            if self._shuffle() and (self.m <= 3 or self._cycles_ok()):
+                return list(self._perm)
+        return []
+
+    def samples(self) -> Iterator[List[int]]:
+        """Yields an endless stream of samples (see sample())"""
+        if self.m > self.n: return
+        while True:
+            yield self.sample()
+
+def constrained(n: int, m: int = 2, bl: Blacklist = None) -> List[int]:
     """
     Return a random derangement given the constraints that minimum cycle must
     be >= m and neither pair in any of the pairs in bl may follow each other in
     a cycle (ie, for two santas in bl, niether can be assigned to each other).
+
+    For more than one sample use a DerangementSampler directly.
     """
     # TODO: check to make sure this can return given bl!
-    if m > n: return []
-    perm = generate_rejection(n)
-    while not check_constraints(perm, m, bl):
-        perm = generate_rejection(n)
+    return DerangementSampler(n, m, bl).sample()
+
+
+def sattolo(n: int) -> List[int]:
+    """
+    Generate a uniformly random cyclic permutation of [n] (a single n-cycle)
+    in O(n) using Sattolo's algorithm: a Fisher-Yates shuffle which never
+    lets an element swap with itself.
+    """
+    perm = list(range(n))
+    for i in range(n-1, 0, -1):
+        k = random.randrange(i) # 0 <= k < i
+        perm[i], perm[k] = perm[k], perm[i]
+    return perm
+
+# chain() draws uniform chains until one avoids the blacklist while at least
+# this fraction of chains are expected to
+CHAIN_THRESHOLD = 1e-2
+
+# Number of fresh Sattolo cycles chain() repairs before giving up
+CHAIN_RESTARTS = 10
+
+def chain(n: int, bl: Blacklist = None) -> List[int]:
+    """
+    Return a random single n-cycle (a "gift chain" where 0 gives to perm[0],
+    who gives to perm[perm[0]], and so on back to 0) in which no pair in bl
+    are assigned to each other. Returns [] if no such chain could be found.
+
+    Each of the F forbidden (giver, recipient) pairs is in a uniformly random
+    chain with probability 1/(n-1), so about exp(-F/(n-1)) of the chains
+    avoid the blacklist. While that is at least CHAIN_THRESHOLD, uniform
+    chains are drawn until one does, so the result is uniformly distributed
+    over the allowed chains.
+
+    With a denser blacklist a uniform chain is instead repaired by moving a
+    santa from each forbidden position to a random spot in the chain. Every
+    move keeps the permutation a single cycle, so this is fast, but the
+    result is NOT uniform: some allowed chains come up noticeably more often
+    than others (1.4x as often in a small example).
+    """
+    if n < 2: return []
+    forbidden = forbidden_edges(bl)
+    if not forbidden:
+        return sattolo(n)
+
+    accept = math.exp(-len(forbidden)/(n-1))
+    if accept >= CHAIN_THRESHOLD:
+        for attempt in range(int(10/accept)):
+            perm = sattolo(n)
+            if check_forbidden(perm, forbidden):
+                return perm
+
+    def bad_edges(order: List[int], positions: Set[int]) -> Set[int]:
+        # positions k whose edge order[k] -> order[k+1] is forbidden
+        return {k for k in positions if (order[k], order[(k+1) % n]) in forbidden}
+
+    for attempt in range(CHAIN_RESTARTS):
+        perm = sattolo(n)
+
+        # order lists the santas in the order they appear in the cycle
+        order = [0]
+        while len(order) < n:
+            order.append(perm[order[-1]])
+
+        bad = bad_edges(order, set(range(n)))
+        moves = 0
+        while bad and moves < 100*n:
+            moves += 1
+            # Swap the recipient at a forbidden position with a random santa.
+            # Reordering the santas along the cycle never splits it.
+            a = (random.choice(tuple(bad)) + 1) % n
+            j = random.randrange(n)
+            if j == a: continue
+            affected = {(a-1) % n, a, (j-1) % n, j}
+            before = bad_edges(order, affected)
+            order[a], order[j] = order[j], order[a]
+            after = bad_edges(order, affected)
+            if len(after) > len(before):
+                # undo a move which made things worse
+                order[a], order[j] = order[j], order[a]
+                continue
+            bad -= before
+            bad |= after
+
+        if not bad:
+            for k in range(n):
+                perm[order[k]] = order[(k+1) % n]
+            return perm
+    return []
+
+
+def estimate_acceptance(n: int, m: int = 2, bl: Blacklist = None,
+        forbidden: Edges = None) -> float:
+    """
+    Estimate the probability that a uniformly random permutation of [n]
+    satisfies the constraints (which is the fraction of samples that
+    constrained() accepts). `forbidden` may give extra (giver, recipient)
+    pairs to exclude.
+
+    The number of cycles of length k in a random permutation is roughly
+    Poisson with mean 1/k, and each of the forbidden (giver, recipient) pairs
+    appears with probability 1/n, so the chance of avoiding all of them is
+    about exp(-(1 + 1/2 + ... + 1/(m-1) + len(forbidden)/n)).
+    """
+    if n < 1: return 1.0
+    if m < 2: m = 2
+    if m > n: return 0.0
+    short_cycles = sum(1/k for k in range(1, m))
+    forbidden = forbidden_edges(bl) | (forbidden or set())
+    return math.exp(-(short_cycles + len(forbidden)/n))
+
+def hopcroft_karp(n: int, adj: List[List[int]]) -> Optional[List[int]]:
+    """
+    Find a perfect matching of givers to recipients in the bipartite graph
+    where adj[i] lists the recipients giver i may be assigned, using the
+    Hopcroft-Karp algorithm (O(E sqrt(n))). Returns the matching as a
+    permutation or None if there is no perfect matching.
+    """
+    matching = max_matching(n, adj)
+    if -1 in matching:
+        return None
+    return matching
+
+def max_matching(n: int, adj: List[List[int]],
+        start: List[int] = None) -> List[int]:
+    """
+    Find a maximum matching of givers to recipients as in hopcroft_karp(),
+    growing the matching `start` (a valid matching in adj, as returned by a
+    previous call) if given. Returns the recipient matched to each giver, or
+    -1 for givers left unmatched.
+    """
+    INF = n + 1
+    match_giver = list(start) if start else [-1] * n   # recipient matched to each giver
+    match_recip = [-1] * n      # giver matched to each recipient
+    for u, v in enumerate(match_giver):
+        if v != -1:
+            match_recip[v] = u
+    dist = [0] * n
+
+    def bfs() -> bool:
+        # Layer the free givers and the alternating paths leaving them
+        queue: Deque[int] = collections.deque()
+        for u in range(n):
+            if match_giver[u] == -1:
+                dist[u] = 0
+                queue.append(u)
+            else:
+                dist[u] = INF
+        found = False
+        while queue:
+            u = queue.popleft()
+            for v in adj[u]:
+                w = match_recip[v]
+                if w == -1:
+                    found = True
+                elif dist[w] == INF:
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+        return found
+
+    def dfs(u: int) -> bool:
+        # Look for an augmenting path from u along the BFS layers (iteratively
+        # so large graphs don't hit the recursion limit)
+        stack = [(u, iter(adj[u]))]
+        path = []
+        while stack:
+            w, neighbors = stack[-1]
+            for v in neighbors:
+                x = match_recip[v]
+                if x == -1:
+                    # Found a free recipient: flip the path
+                    path.append((w, v))
+                    for a, b in path:
+                        match_giver[a] = b
+                        match_recip[b] = a
+                    return True
+                if dist[x] == dist[w] + 1:
+                    path.append((w, v))
+                    stack.append((x, iter(adj[x])))
+                    break
+            else:
+                # dead end: remove w from further searches this phase
+                dist[w] = INF
+                stack.pop()
+                if path: path.pop()
+        return False
+
+    while bfs():
+        for u in range(n):
+            if match_giver[u] == -1:
+                dfs(u)
+    return match_giver
+
+def sample_edges(n: int, forbidden: Edges, degree: int) -> List[List[int]]:
+    """
+    Returns adjacency lists with up to `degree` random allowed recipients for
+    each giver (all of them if fewer are allowed). A random bipartite graph of
+    degree O(log n) almost always contains a perfect matching, so this keeps
+    the matching search sparse unless the constraints are very dense.
+    """
+    banned: Dict[int, Set[int]] = collections.defaultdict(set)
+    for a, b in forbidden:
+        banned[a].add(b)
+
+    adj = []
+    for i in range(n):
+        bad = banned[i]
+        if 2*(len(bad)+1) < n and degree < n//2:
+            # mostly allowed: pick at random until we have enough
+            picks: Set[int] = set()
+            while len(picks) < degree:
+                j = random.randrange(n)
+                if j != i and j not in bad:
+                    picks.add(j)
+            adj.append(list(picks))
+        else:
+            allowed = [j for j in range(n) if j != i and j not in bad]
+            random.shuffle(allowed)
+            adj.append(allowed[:degree])
+    return adj
+
+def repair_cycles(perm: List[int], m: int, forbidden: Edges, tries: int = 1000,
+        near: List[List[int]] = None) -> bool:
+    """
+    Merge any cycles of perm shorter than m into other cycles (in place) by
+    swapping the recipients of two santas in different cycles, which joins
+    the two cycles into one. Returns False if the repair failed.
+
+    If near is given, near[i] lists santas to try swapping with santa i
+    before falling back to random santas (see mincost()).
+    """
+    n = len(perm)
+    if m <= 2: return True
+
+    # label each santa with the index of its cycle
+    cycles = decompose(perm)
+    label = [0] * n
+    members: List[List[int]] = []
+    for c, cycle in enumerate(cycles):
+        for x in cycle:
+            label[x] = c
+        members.append(list(cycle))
+
+    short = [c for c, cycle in enumerate(members) if len(cycle) < m]
+    while short:
+        c = short.pop()
+        if len(members[c]) >= m or not members[c]:
+            continue
+        for attempt in range(tries):
+            i = random.choice(members[c])
+            if near is not None and attempt < tries//2 and near[i]:
+                j = random.choice(near[i])
+            else:
+                j = random.randrange(n)
+            if label[j] == c: continue
+            if (i, perm[j]) in forbidden or (j, perm[i]) in forbidden: continue
+            perm[i], perm[j] = perm[j], perm[i]
+            # relabel the smaller cycle
+            big, small = label[j], c
+            if len(members[big]) < len(members[small]):
+                big, small = small, big
+            for x in members[small]:
+                label[x] = big
+            members[big].extend(members[small])
+            members[small] = []
+            if len(members[big]) < m:
+                short.append(big)
+            break
+        else:
+            return False
+    return True
+
+class MCMCStats:
+    """
+    Diagnostics filled in by mcmc()
+    """
+    def __init__(self):
+        self.seed_degree = 0    # recipients per giver in the matching graph
+        self.steps = 0          # proposed moves
+        self.accepted = 0       # moves which kept every constraint
+        self.swaps = 0          # accepted swaps of two recipients
+        self.rotations = 0      # accepted rotations of three recipients
+        self.moved = 0          # santas whose recipient differs from the seed
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted/self.steps if self.steps else 0.0
+
+    def __repr__(self):
+        return "%s: {steps: %d, acceptance_rate: %.3f, swaps: %d, rotations: %d, moved: %d, seed_degree: %d}" % (
+                self.__class__, self.steps, self.acceptance_rate, self.swaps,
+                self.rotations, self.moved, self.seed_degree)
+
+# The default number of MCMC steps is MIXING_FACTOR * n * ln(n)
+MIXING_FACTOR = 4
+
+def mixing_steps(n: int) -> int:
+    """Default number of steps run by mcmc() for size n"""
+    return int(MIXING_FACTOR * n * math.log(max(n, 2))) + 100
+
+def mcmc(n: int, m: int = 2, bl: Blacklist = None, steps: int = None,
+        stats: MCMCStats = None, forbidden: Edges = None) -> List[int]:
+    """
+    Return a random derangement satisfying the constraints (as for
+    constrained()) using a Markov chain instead of rejection sampling. This
+    stays fast when the constraints are so dense that only a tiny fraction
+    of permutations satisfy them.
+
+    A valid starting assignment is found with a bipartite matching
+    (Hopcroft-Karp) over the allowed (giver, recipient) pairs, with short
+    cycles then merged until every cycle has length >= m. The chain then
+    proposes `steps` random moves (swapping the recipients of two santas or
+    rotating the recipients of three) and keeps every move which satisfies
+    the constraints. The proposals are symmetric, so the chain's stationary
+    distribution is uniform over the valid assignments it can reach.
+
+    `forbidden` may give extra (giver, recipient) pairs to exclude. If
+    `stats` is given it is filled in with diagnostics. Returns [] if no
+    valid assignment could be found.
+    """
+    if m < 2: m = 2
+    if m > n or n < 2: return []
+    forbidden = forbidden_edges(bl) | (forbidden or set())
+    if stats is None: stats = MCMCStats()
+    stats.steps = stats.accepted = stats.swaps = stats.rotations = 0
+
+    # Seed: find a matching in a sparse random subgraph of allowed pairs,
+    # doubling its degree until one exists
+    degree = min(n-1, 2*int(math.log(n)) + 4)
+    while True:
+        perm = hopcroft_karp(n, sample_edges(n, forbidden, degree))
+        if perm is not None or degree >= n-1:
+            break
+        degree = min(n-1, 2*degree)
+    stats.seed_degree = degree
+    if perm is None or not repair_cycles(perm, m, forbidden):
+        return []
+    seed = list(perm)
+
+    def short_cycle(start: int) -> bool:
+        # True if start is on a cycle shorter than m
+        cur = perm[start]
+        for length in range(1, m):
+            if cur == start: return True
+            cur = perm[cur]
+        return False
+
+    if steps is None: steps = mixing_steps(n)
+    for step in range(steps):
+        stats.steps += 1
+        if n > 2 and random.random() < 0.5:
+            # rotate the recipients of i, j, k
+            i, j, k = random.sample(range(n), 3)
+            pi, pj, pk = perm[i], perm[j], perm[k]
+            if pj == i or pk == j or pi == k: continue
+            if (i, pj) in forbidden or (j, pk) in forbidden or (k, pi) in forbidden: continue
+            perm[i], perm[j], perm[k] = pj, pk, pi
+            if m > 2 and (short_cycle(i) or short_cycle(j) or short_cycle(k)):
+                perm[i], perm[j], perm[k] = pi, pj, pk
+                continue
+            stats.rotations += 1
+        else:
+            # swap the recipients of i and j
+            i, j = random.sample(range(n), 2)
+            pi, pj = perm[i], perm[j]
+            if pj == i or pi == j: continue
+            if (i, pj) in forbidden or (j, pi) in forbidden: continue
+            perm[i], perm[j] = pj, pi
+            if m > 2 and (short_cycle(i) or short_cycle(j)):
+                perm[i], perm[j] = pi, pj
+                continue
+            stats.swaps += 1
+        stats.accepted += 1
+
+    stats.moved = sum(1 for a, b in zip(perm, seed) if a != b)
+    return perm
+
+
+def disjoint(n: int, k: int, m: int = 2, bl: Blacklist = None,
+        threshold: float = 1e-3, tries: int = 10) -> List[List[int]]:
+    """
+    Return k random derangements satisfying the constraints (as for
+    constrained()) which are mutually edge-disjoint: no giver is assigned the
+    same recipient twice, so everybody gives k gifts to k different people.
+
+    The derangements are drawn one after another, each avoiding the pairs
+    already used by the previous ones. Each is drawn by rejection sampling
+    while the estimated acceptance rate stays above `threshold`, and by the
+    matching-seeded MCMC sampler once the used pairs make that too slow.
+    If a draw fails the whole set is restarted, up to `tries` times. Returns
+    [] if no set of k derangements was found.
+    """
+    if k < 1 or m > n or k > n-1: return []
+    base = forbidden_edges(bl)
+    for attempt in range(tries):
+        used: Edges = set()     # pairs used by the derangements so far
+        perms: List[List[int]] = []
+        for r in range(k):
+            forbidden = base | used
+            perm: List[int] = []
+            accept = estimate_acceptance(n, m, forbidden=forbidden)
+            if accept >= threshold:
+                sampler = DerangementSampler(n, m, forbidden=forbidden)
+                perm = sampler.sample(int(10/accept))
+            if not perm:
+                perm = mcmc(n, m, forbidden=forbidden)
+            if not perm:
+                break
+            perms.append(perm)
+            used.update(enumerate(perm))
+        if len(perms) == k:
+            return perms
+    return []
+
+# Candidate recipients per giver considered by mincost()
+MINCOST_NEIGHBOURS = 8
+
+# Each candidate cost is multiplied by a random factor in [1, 1+jitter) so
+# that mincost() picks among the nearly optimal assignments at random
+MINCOST_JITTER = 0.1
+
+def nearest_neighbours(points: Sequence[Tuple[float, float]], k: int,
+        query: Iterable[int] = None) -> List[List[int]]:
+    """
+    Returns the indices of the k nearest other points to each of the 2D
+    points (fewer if there are fewer points), nearest first. If query is
+    given, only the neighbours of the points with those indices are
+    returned (in the same order).
+
+    The points are bucketed in a grid with about k points per cell, and the
+    cells around each point are searched in rings of growing radius until
+    the points in the next ring cannot be closer than the k found so far, so
+    this is about O(n k) for points which are not too clustered.
+    """
+    n = len(points)
+    query = range(n) if query is None else list(query)
+    k = min(k, n-1)
+    if k <= 0: return [[] for i in query]
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    x0, y0 = min(xs), min(ys)
+    area = (max(xs) - x0) * (max(ys) - y0)
+    size = math.sqrt(area * k / n) or max(max(xs) - x0, max(ys) - y0, 1.0)
+
+    grid: Dict[Tuple[int, int], List[int]] = collections.defaultdict(list)
+    cells = []
+    for i in range(n):
+        cell = (int((xs[i] - x0) / size), int((ys[i] - y0) / size))
+        grid[cell].append(i)
+        cells.append(cell)
+    extent = max(max(c[0] for c in cells), max(c[1] for c in cells))
+
+    neighbours = []
+    for i in query:
+        x, y = xs[i], ys[i]
+        cx, cy = cells[i]
+        found: List[Tuple[float, int]] = []
+        for r in range(extent+1):
+            # the cells at Chebyshev distance r from the cell of point i
+            for gx in range(cx-r, cx+r+1):
+                step = 1 if gx in (cx-r, cx+r) else 2*r
+                for gy in range(cy-r, cy+r+1, step or 1):
+                    for j in grid.get((gx, gy), ()):
+                        if j != i:
+                            found.append(((xs[j]-x)**2 + (ys[j]-y)**2, j))
+            if len(found) >= k:
+                found = heapq.nsmallest(k, found)
+                # every point beyond ring r is at least r cells away
+                if found[-1][0] <= (r*size)**2:
+                    break
+        neighbours.append([j for d, j in found])
+    return neighbours
+
+def auction(n: int, adj: List[List[int]], cost: List[List[float]],
+        epsilon: float, max_bids: int = None) -> Optional[List[int]]:
+    """
+    Find a perfect matching of givers to recipients which nearly minimizes
+    the total cost, where cost[i][e] is the cost of assigning giver i to
+    recipient adj[i][e], using the auction algorithm with epsilon scaling.
+    The total cost is within n*epsilon of the minimum.
+
+    Unassigned givers bid for their best recipient at current prices, raising
+    its price by how much better it is than their second best. The graph
+    must contain a perfect matching (check with hopcroft_karp()) or the
+    auction will not end; returns None if it has not ended after max_bids
+    bids (default 1000 per giver).
+    """
+    if max_bids is None: max_bids = 1000 * n
+    top = max((c for row in cost for c in row), default=0.0)
+    price = [0.0] * n
+    owner = [-1] * n        # giver assigned each recipient
+    assigned = [-1] * n     # recipient assigned each giver
+    bids = 0
+
+    eps = max(top / 4, epsilon)
+    while True:
+        # each scaling phase restarts the auction with the previous prices
+        owner = [-1] * n
+        assigned = [-1] * n
+        unassigned = list(range(n))
+        random.shuffle(unassigned)
+        while unassigned:
+            i = unassigned.pop()
+            # find the best and second best value (-cost - price) for giver i
+            best = second = -math.inf
+            choice = -1
+            row = cost[i]
+            for e, j in enumerate(adj[i]):
+                v = -row[e] - price[j]
+                if v > best:
+                    best, second, choice = v, best, j
+                elif v > second:
+                    second = v
+            if second == -math.inf:
+                # only one candidate, so giver i has to have it
+                second = best - top - eps
+            price[choice] += best - second + eps
+            prev = owner[choice]
+            owner[choice] = i
+            assigned[i] = choice
+            if prev != -1:
+                assigned[prev] = -1
+                unassigned.append(prev)
+            bids += 1
+            if bids > max_bids:
+                return None
+        if eps <= epsilon:
+            return assigned
+        eps = max(eps / 4, epsilon)
+
+def widen_unmatched(points: Sequence[Tuple[float, float]], adj: List[List[int]],
+        forbidden: Edges, matching: List[int], k: int, degree: int = 0):
+    """
+    Add edges to adj for the givers and recipients which the maximum
+    matching leaves unmatched: from each unmatched giver to its k nearest
+    neighbours, and to each unmatched recipient from its k nearest
+    neighbours, plus `degree` random edges each if nearby ones are not
+    enough. Only the unmatched santas get new edges, so the graph stays
+    sparse and (unless degree > 0) its edges stay short.
+    """
+    n = len(points)
+    givers = set(i for i in range(n) if matching[i] == -1)
+    recipients = set(range(n)).difference(matching)
+    free = sorted(givers | recipients)
+
+    def connect(i: int, j: int):
+        if i != j and (i, j) not in forbidden and j not in adj[i]:
+            adj[i].append(j)
+
+    for i, near in zip(free, nearest_neighbours(points, k, free)):
+        for j in near:
+            if i in givers:
+                connect(i, j)
+            if i in recipients:
+                connect(j, i)
+        for r in range(degree):
+            if i in givers:
+                connect(i, random.randrange(n))
+            if i in recipients:
+                connect(random.randrange(n), i)
+
+def mincost(points: Sequence[Tuple[float, float]], m: int = 2, bl: Blacklist = None,
+        cost: Callable[[int, int], float] = None, k: int = MINCOST_NEIGHBOURS,
+        jitter: float = MINCOST_JITTER) -> List[int]:
+    """
+    Return a random derangement of the santas at the 2D points which
+    satisfies the mincycle and blacklist constraints and has a low total
+    cost, where cost(i, j) is the cost of santa i giving to santa j (the
+    distance between their points by default).
+
+    Each santa may only give to one of their k nearest neighbours, and a
+    nearly cheapest assignment on this sparse graph is found by auction().
+    If the neighbours alone can't be matched, the santas left over are
+    given more edges (see widen_unmatched()). Costs
+    are jittered by a random factor (see MINCOST_JITTER) so the result is
+    one of many cheap assignments rather than always the same one. Mutual
+    neighbours make short cycles common, so cycles shorter than m are then
+    merged with the cycle of a nearby santa. Returns [] on failure.
+
+    Unlike the other generators the result is far from uniform: it is
+    deliberately biased towards cheap assignments.
+    """
+    n = len(points)
+    if m > n or n < 2: return []
+    if cost is None:
+        def cost(i: int, j: int) -> float:
+            return math.dist(points[i], points[j])
+    forbidden = forbidden_edges(bl)
+    near = nearest_neighbours(points, k)
+    adj = [[j for j in near[i] if (i, j) not in forbidden] for i in range(n)]
+
+    # Make sure a perfect matching exists, widening the neighbourhoods of
+    # the santas left unmatched if needed. Random (long) edges make the
+    # auction much slower, so they are only added if that did not help.
+    matching = max_matching(n, adj)
+    for attempt in range(10):
+        if -1 not in matching:
+            break
+        degree = max(2, int(math.log(n))) if attempt >= 3 else 0
+        widen_unmatched(points, adj, forbidden, matching, k << (attempt+1), degree)
+        matching = max_matching(n, adj, matching)
+    else:
+        return []
+
+    weights = [[cost(i, j) * (1 + jitter*random.random()) for j in adj[i]]
+            for i in range(n)]
+    mean = sum(map(sum, weights)) / sum(map(len, weights))
+    perm = auction(n, adj, weights, mean / 100)
+    if perm is None:
+        perm = hopcroft_karp(n, adj)
+    assert perm is not None
+    if not repair_cycles(perm, m, forbidden, near=near):
+        return []
     return perm
@@ -0,0 +1,340 @@
+"""
+This module audits the derangement generators for uniformity by streaming
+a large number of samples into compact counters (it requires numpy).
+
+Instead of keeping every distinct sample, each sample is reduced to an
+integer: its rank (its index among all n! permutations) when n is small
+enough to count every permutation, or otherwise a fixed-width hash which
+selects one of a number of buckets. A chi-square test compares the observed
+counts to those expected from a uniform generator.
+
+In exact mode the expected counts are spread over the valid assignments,
+which are found by checking all n! permutations at once with numpy. A good
+hash spreads the valid assignments evenly over the buckets only up to
+random fluctuations in how many land in each bucket, so in hashed mode the
+number of buckets is chosen (see bucket_count()) to keep those fluctuations
+from showing up in the test.
+
+The giver -> recipient counts (the per-position marginals) are also kept
+and, when there is no blacklist, tested. Sampling is split into chunks
+which are run in parallel worker processes and merged as they finish.
+
+Example:
+
+    audit = run(20, m=3, samples=10**6)
+    print(audit.report())
+"""
+import concurrent.futures
+import hashlib
+import math
+import random
+from array import array
+from typing import Optional, List, Tuple, Callable, Sequence
+
+import numpy as np # type:ignore
+
+import sinterbot.algorithms as algo
+
+# Largest n for which counts are kept per rank (n! counters, 29MB at n=10)
+EXACT_MAX_N = 10
+
+# Largest n for which the n*n giver -> recipient counts are kept
+MARGINAL_MAX_N = 2000
+
+# Largest number of hash buckets (a power of two) used when n > EXACT_MAX_N
+BUCKETS = 2**16
+
+# Samples drawn by each worker task
+CHUNK = 20000
+
+
+def rank(perm: algo.PermLike) -> int:
+    """
+    Returns the lexicographic rank of perm among all permutations of its
+    elements (its Lehmer code read as a factorial base number).
+    """
+    n = len(perm)
+    r = 0
+    for i in range(n):
+        smaller = 0
+        for j in range(i+1, n):
+            if perm[j] < perm[i]:
+                smaller += 1
+        r = r * (n-i) + smaller
+    return r
+
+
+def perm_hash(perm: algo.PermLike) -> int:
+    """Returns a 64 bit hash of perm"""
+    digest = hashlib.blake2b(array('I', perm).tobytes(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def bucket_count(n: int, m: int, bl: algo.Blacklist, samples: int) -> int:
+    """
+    Returns the number of hash buckets to use for `samples` samples of the
+    valid assignments of n santas.
+
+    With S valid assignments each of B buckets holds about S/B +- sqrt(S/B)
+    of them, so even a uniform generator's expected counts differ between
+    buckets. Tested against a flat expectation this adds about
+    sqrt(B/2)*samples/S standard deviations to the chi-square statistic, so
+    B is the largest power of two (up to BUCKETS) keeping that below 0.1. S
+    is estimated with algorithms.estimate_acceptance().
+    """
+    support = math.factorial(n) * algo.estimate_acceptance(n, m, bl)
+    limit = 2 * (0.1 * support / max(samples, 1))**2
+    buckets = 2
+    while buckets * 2 <= min(limit, BUCKETS):
+        buckets *= 2
+    return buckets
+
+
+def all_permutations(n: int) -> np.ndarray:
+    """Returns every permutation of [n] as the rows of an n! x n array"""
+    perms = np.zeros((1, 1), dtype=np.int8)
+    for k in range(1, n):
+        # insert k at every position of every permutation of [k]
+        perms = np.concatenate([np.insert(perms, pos, k, axis=1)
+            for pos in range(k+1)])
+    return perms[:, :n]
+
+
+def ranks(perms: np.ndarray) -> np.ndarray:
+    """Returns rank() of every row of perms"""
+    count, n = perms.shape
+    r = np.zeros(count, dtype=np.int64)
+    for i in range(n):
+        smaller = (perms[:, i+1:] < perms[:, i:i+1]).sum(axis=1)
+        r = r * (n-i) + smaller
+    return r
+
+
+def chi2_sf(x: float, dof: int) -> float:
+    """
+    Returns the probability that a chi-square distributed variable with dof
+    degrees of freedom is >= x (the p-value of a chi-square test). This is
+    the regularized upper incomplete gamma function Q(dof/2, x/2).
+    """
+    if dof <= 0: return 1.0
+    if x <= 0: return 1.0
+    a, x = dof/2, x/2
+    lg = math.lgamma(a)
+    if x < a + 1:
+        # series for the lower function P
+        term = total = 1/a
+        k = a
+        while abs(term) > abs(total) * 1e-15:
+            k += 1
+            term *= x/k
+            total += term
+        return max(0.0, 1 - total * math.exp(-x + a*math.log(x) - lg))
+    # continued fraction for Q (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1/tiny
+    d = 1/b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an*d + b
+        if abs(d) < tiny: d = tiny
+        c = b + an/c
+        if abs(c) < tiny: c = tiny
+        d = 1/d
+        delta = d*c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return h * math.exp(-x + a*math.log(x) - lg)
+
+
+class Generator:
+    """
+    A picklable description of the generator being audited: the name of a
+    function in sinterbot.algorithms and the constraints to pass it.
+    """
+    def __init__(self, name: str, n: int, m: int = 2,
+            bl: algo.Blacklist = None):
+        self.name = name
+        self.n = n
+        self.m = m
+        self.bl = bl or []
+
+    def __call__(self) -> List[int]:
+        func = getattr(algo, self.name)
+        if self.name in ('constrained', 'mcmc'):
+            return func(self.n, self.m, self.bl)
+        if self.name == 'chain':
+            return func(self.n, self.bl)
+        return func(self.n)
+
+    def valid_rows(self, perms: np.ndarray) -> np.ndarray:
+        """Returns a boolean mask of the rows of perms which valid() accepts"""
+        count, n = perms.shape
+        rows = np.arange(count)
+        # a chain must be a single cycle, i.e. have no cycle shorter than n
+        m = n if self.name == 'chain' else max(self.m, 2)
+        ok = np.ones(count, dtype=bool)
+        for a, b in self.bl:
+            ok &= (perms[:, a] != b) & (perms[:, b] != a)
+        for i in range(n):
+            cur = np.full(count, i, dtype=np.int64)
+            for length in range(1, m):
+                cur = perms[rows, cur]
+                ok &= cur != i
+        return ok
+
+    def valid(self, perm: algo.PermLike) -> bool:
+        """Returns True if perm is one of the assignments we expect"""
+        if self.name == 'chain':
+            return algo.check_single_cycle(perm) and algo.check_blacklist(perm, self.bl)
+        return algo.check_constraints(perm, self.m, self.bl)
+
+
+class Audit:
+    """
+    Counters for the samples from one Generator. Use update() to add
+    samples and merge() to combine the counts from several workers.
+    """
+    def __init__(self, gen: Generator, buckets: int = BUCKETS):
+        self.gen = gen
+        n = gen.n
+        self.total = 0
+        self.invalid = 0    # samples which break the constraints
+        self.exact = n <= EXACT_MAX_N
+        if self.exact:
+            self.counts = np.zeros(math.factorial(n), dtype=np.int64)
+        else:
+            self.counts = np.zeros(buckets, dtype=np.int64)
+        self.marginals: Optional[np.ndarray] = None
+        if n <= MARGINAL_MAX_N:
+            self.marginals = np.zeros((n, n), dtype=np.int64)
+
+    def update(self, perms: Sequence[algo.PermLike]):
+        """Add a batch of samples to the counters"""
+        if not perms: return
+        n = self.gen.n
+        keys = np.empty(len(perms), dtype=np.uint64)
+        for i, p in enumerate(perms):
+            if not self.gen.valid(p):
+                self.invalid += 1
+            keys[i] = rank(p) if self.exact else perm_hash(p) % len(self.counts)
+        np.add.at(self.counts, keys.astype(np.int64), 1)
+        if self.marginals is not None:
+            # count each giver -> recipient pair at index giver*n + recipient
+            flat = np.asarray(perms, dtype=np.int64) + np.arange(n) * n
+            self.marginals += np.bincount(flat.ravel(),
+                    minlength=n*n).reshape(n, n)
+        self.total += len(perms)
+
+    def merge(self, other: 'Audit'):
+        """Add the counts of other (an Audit of the same Generator)"""
+        self.total += other.total
+        self.invalid += other.invalid
+        self.counts += other.counts
+        if self.marginals is not None:
+            self.marginals += other.marginals
+
+    def support(self) -> np.ndarray:
+        """
+        Returns a boolean mask of the counters which a uniform generator
+        should hit: the ranks of all valid permutations in exact mode, or
+        every bucket otherwise.
+        """
+        if not self.exact:
+            return np.ones(len(self.counts), dtype=bool)
+        perms = all_permutations(self.gen.n)
+        mask = np.zeros(len(self.counts), dtype=bool)
+        mask[ranks(perms[self.gen.valid_rows(perms)])] = True
+        return mask
+
+    def chisquare(self) -> Tuple[float, int, float]:
+        """
+        Chi-square test of the counts against a uniform distribution over
+        the support. Returns (statistic, degrees of freedom, p-value).
+        """
+        mask = self.support()
+        observed = self.counts[mask]
+        expected = self.total / len(observed)
+        stat = float(((observed - expected)**2).sum() / expected)
+        dof = len(observed) - 1
+        return stat, dof, chi2_sf(stat, dof)
+
+    def marginal_pvalues(self) -> Optional[np.ndarray]:
+        """
+        Chi-square test for each giver that their recipient is uniformly
+        distributed over everybody else. Returns the p-value for each giver,
+        or None if marginals were not kept or there is a blacklist (which
+        makes some allowed recipients more likely than others, so there is
+        no simple expectation to test against).
+        """
+        if self.marginals is None or self.total == 0 or self.gen.bl:
+            return None
+        n = self.gen.n
+        expected = self.total / (n-1)
+        pvalues = np.ones(n)
+        for i in range(n):
+            observed = np.delete(self.marginals[i], i)
+            stat = float(((observed - expected)**2).sum() / expected)
+            pvalues[i] = chi2_sf(stat, n-2)
+        return pvalues
+
+    def report(self) -> str:
+        """Returns a human readable summary of the audit"""
+        stat, dof, p = self.chisquare()
+        lines = [
+            "Generator: %s (n=%d, mincycle=%d, %d blacklist pairs)" % (
+                self.gen.name, self.gen.n, self.gen.m, len(self.gen.bl)),
+            "Samples: %d (%d invalid)" % (self.total, self.invalid),
+            "%s: chi-square=%.1f dof=%d p=%.4f" % (
+                "Ranks" if self.exact else "Hash buckets", stat, dof, p),
+        ]
+        pvalues = self.marginal_pvalues()
+        if pvalues is not None:
+            # With n independent tests, the smallest p-value is compared to
+            # a Bonferroni corrected threshold
+            lines.append("Marginals: min p=%.4f over %d givers (Bonferroni p=%.4f)" % (
+                pvalues.min(), len(pvalues), min(1.0, pvalues.min() * len(pvalues))))
+        return "\n".join(lines)
+
+
+def sample_chunk(gen: Generator, count: int, seed: int,
+        buckets: int = BUCKETS) -> Audit:
+    """Draw count samples from gen (seeding random with seed) into an Audit"""
+    random.seed(seed)
+    audit = Audit(gen, buckets)
+    batch: List[List[int]] = []
+    for i in range(count):
+        batch.append(gen())
+        if len(batch) == 1000:
+            audit.update(batch)
+            batch = []
+    audit.update(batch)
+    return audit
+
+
+def run(n: int, m: int = 2, bl: algo.Blacklist = None, samples: int = 10**5,
+        name: str = 'constrained', jobs: int = None, seed: int = None,
+        progress: Callable[[Audit], None] = None) -> Audit:
+    """
+    Audit the generator algorithms.<name> by drawing samples in a pool of
+    worker processes. progress (if given) is called with the merged Audit
+    each time a chunk finishes.
+    """
+    gen = Generator(name, n, m, bl)
+    rng = random.Random(seed)
+    buckets = bucket_count(n, m, gen.bl, samples)
+    audit = Audit(gen, buckets)
+    sizes = [CHUNK] * (samples // CHUNK)
+    if samples % CHUNK:
+        sizes.append(samples % CHUNK)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(sample_chunk, gen, size, rng.getrandbits(64), buckets)
+                for size in sizes]
+        for future in concurrent.futures.as_completed(futures):
+            audit.merge(future.result())
+            if progress is not None:
+                progress(audit)
+    return audit
@@ -0,0 +1,226 @@
+"""
+This module collects delivery metrics for `sinterbot send`: how long each
+message took to send, which SMTP reply codes the server answered with, how
+long it took to connect, start TLS and log in, and the overall number of
+messages sent per second.
+
+At the end of a run the metrics can be written as a Prometheus text format
+file (for example for node_exporter's textfile collector) and/or as a JSON
+summary:
+
+    metrics = SendMetrics()
+    with metrics.phase('connect'):
+        server = smtplib.SMTP(host)
+    ...
+    metrics.message(elapsed, 250)
+    metrics.finish()
+    metrics.write_prometheus('send.prom')
+"""
+import bisect
+import collections
+import json
+import os
+import time
+from typing import Dict, List, Sequence, Union
+
+# Upper bounds (in seconds) of the histogram buckets for message latency
+# and connection phases
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+        10.0, 30.0)
+
+# Prefix of every Prometheus metric name
+PREFIX = "sinterbot_send"
+
+
+class Histogram:
+    """
+    Keeps every observed value (a run sends at most one message per santa)
+    so the JSON summary can give exact quantiles, and counts them into
+    cumulative buckets for Prometheus.
+    """
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.values: List[float] = []
+
+    def observe(self, value: float):
+        self.values.append(value)
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    @property
+    def sum(self) -> float:
+        return sum(self.values)
+
+    def cumulative(self) -> List[int]:
+        """Returns the number of values <= each bucket bound"""
+        counts = [0] * len(self.buckets)
+        for v in self.values:
+            i = bisect.bisect_left(self.buckets, v)
+            if i < len(counts):
+                counts[i] += 1
+        for i in range(1, len(counts)):
+            counts[i] += counts[i-1]
+        return counts
+
+    def quantile(self, q: float) -> float:
+        """Returns the q-quantile (0 <= q <= 1) of the values (0 if none)"""
+        if not self.values: return 0.0
+        values = sorted(self.values)
+        return values[min(len(values)-1, int(q * len(values)))]
+
+    def summary(self) -> Dict[str, float]:
+        if not self.values:
+            return {'count': 0, 'sum': 0.0}
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': min(self.values),
+            'mean': self.sum / self.count,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': max(self.values),
+        }
+
+
+class Timer:
+    """Context manager which observes the time spent in its block"""
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed)
+        return False
+
+
+class SendMetrics:
+    """
+    Metrics for one run of the send loop. Call message() after each attempt
+    to send a message, wrap each connection step in phase(), and call
+    finish() once the loop is done.
+    """
+    def __init__(self):
+        self.latency = Histogram()
+        self.phases: Dict[str, Histogram] = collections.OrderedDict()
+        # SMTP reply codes (or 'disconnected' when there was no reply)
+        self.responses: Dict[Union[int, str], int] = collections.Counter()
+        self.sent = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def phase(self, name: str) -> Timer:
+        """
+        Returns a Timer for a connection phase ('connect', 'starttls',
+        'login' or 'quit').
+        """
+        return Timer(self.phases.setdefault(name, Histogram()))
+
+    def message(self, seconds: float, code: Union[int, str], ok: bool = True):
+        """Record an attempt to send a message and its reply code"""
+        self.latency.observe(seconds)
+        self.responses[code] += 1
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def finish(self):
+        """Stop the clock for the whole run"""
+        self.elapsed = time.perf_counter() - self.start
+
+    @property
+    def rate(self) -> float:
+        """Messages sent per second over the whole run"""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> Dict:
+        """Returns the metrics as a dict, as written by write_json()"""
+        return {
+            'messages': {'sent': self.sent, 'failed': self.failed},
+            'elapsed_seconds': self.elapsed,
+            'messages_per_second': self.rate,
+            'responses': {str(code): count for code, count in sorted(
+                self.responses.items(), key=lambda item: str(item[0]))},
+            'message_seconds': self.latency.summary(),
+            'phase_seconds': {name: h.summary() for name, h in self.phases.items()},
+        }
+
+    def prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+
+        def histogram(name: str, help: str, hists: Dict[str, Histogram], label: str = ''):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for value, h in hists.items():
+                labels = '%s="%s",' % (label, value) if label else ''
+                for bound, count in zip(h.buckets, h.cumulative()):
+                    lines.append('%s_bucket{%sle="%g"} %d' % (name, labels, bound, count))
+                lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, h.count))
+                labels = '{%s}' % labels.rstrip(',') if labels else ''
+                lines.append("%s_sum%s %r" % (name, labels, h.sum))
+                lines.append("%s_count%s %d" % (name, labels, h.count))
+
+        def metric(name: str, kind: str, help: str, samples: Dict[str, float]):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples.items():
+                lines.append("%s%s %r" % (name, labels, value))
+
+        histogram(PREFIX + "_message_seconds",
+                "Time taken to send each message.", {'': self.latency})
+        histogram(PREFIX + "_phase_seconds",
+                "Time taken by each step of setting up the SMTP connection.",
+                self.phases, 'phase')
+        metric(PREFIX + "_messages_total", "counter", "Messages by result.",
+                {'{result="sent"}': self.sent, '{result="failed"}': self.failed})
+        metric(PREFIX + "_responses_total", "counter", "SMTP reply codes to sent messages.",
+                {'{code="%s"}' % code: count for code, count in self.responses.items()})
+        metric(PREFIX + "_duration_seconds", "gauge",
+                "Duration of the whole send run.", {'': self.elapsed})
+        metric(PREFIX + "_messages_per_second", "gauge",
+                "Messages sent per second over the whole run.", {'': self.rate})
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        write_atomic(path, self.prometheus())
+
+    def write_json(self, path: str):
+        write_atomic(path, json.dumps(self.summary(), indent=2) + "\n")
+
+
+def reply_code(error: Exception) -> Union[int, str]:
+    """
+    Returns the SMTP reply code carried by an smtplib exception, or
+    'disconnected', 'timeout' or 'error' if it has none.
+    """
+    code = getattr(error, 'smtp_code', None)
+    if code is not None:
+        return code
+    # SMTPRecipientsRefused has a (code, message) for each recipient
+    for code, msg in getattr(error, 'recipients', {}).values():
+        return code
+    if type(error).__name__ == 'SMTPServerDisconnected':
+        return 'disconnected'
+    if isinstance(error, TimeoutError):
+        return 'timeout'
+    return 'error'
+
+
+def write_atomic(path: str, text: str):
+    """
+    Write text to path through a temporary file, so a collector reading
+    the file never sees half of it.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,208 @@
+"""
+This module implements a long-running lookup service for secret santa
+assignments, so that a portal can ask for a santa's recipient without
+re-parsing and re-validating the config file for every request.
+
+The configs are loaded once into an email -> recipients index, and each
+config is reloaded when its modification time changes. Lookups are answered
+over local HTTP:
+
+    GET /lookup?email=user1@email.tld
+
+or over a Unix socket, where the client writes one email address per line
+and reads back one line of JSON per request. Either way the answer is:
+
+    {"email": "user1@email.tld", "assignments": [{"config": "xmas.conf",
+     "santa": "Santa A", "recipients": [{"name": "Santa D", "email":
+     "user4@email.tld"}]}]}
+"""
+import http.server
+import json
+import logging
+import os
+import socketserver
+import stat
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+import sinterbot.sinterconf as config
+
+log = logging.getLogger(__name__)
+
+
+class Index:
+    """
+    Maps the email of each santa in one config file to their name and
+    recipients. Call refresh() to reload the config if it has changed.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime: Optional[int] = None
+        self.entries: Dict[str, Dict] = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reload the config if its modification time changed. If the new
+        config fails to load the old index is kept.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            log.error("Could not stat %s: %s" % (self.path, e))
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            c = config.SinterConf.parse_and_validate(self.path)
+        except Exception as e:
+            # whatever is wrong with the edited file, keep answering lookups
+            log.error("Could not load %s, keeping previous assignments: %s" % (self.path, repr(e)))
+            return
+
+        entries = {}
+        if c.derangement:
+            for santa, recipients in c.get_all_assignments().items():
+                entries[santa.email] = {
+                    'config': self.path,
+                    'santa': santa.name,
+                    'recipients': [{'name': r.name, 'email': r.email}
+                        for r in recipients],
+                }
+        else:
+            log.error("%s does not contain a derangement" % self.path)
+        # swap in the new index in one step so lookups never see half of it
+        self.entries = entries
+        self.mtime = mtime
+        log.info("Loaded %d assignments from %s" % (len(entries), self.path))
+
+    def lookup(self, email: str) -> Optional[Dict]:
+        return self.entries.get(email)
+
+
+class Lookup:
+    """
+    Answers lookups from the Index of every config, checking the configs'
+    modification times at most once every check_interval seconds.
+    """
+    def __init__(self, paths: List[str], check_interval: float = 1.0):
+        self.indexes = [Index(path) for path in paths]
+        self.check_interval = check_interval
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            for index in self.indexes:
+                index.refresh()
+
+    def lookup(self, email: str) -> Dict:
+        """Returns the answer to a lookup (see module docstring)"""
+        self.refresh()
+        email = email.strip()
+        assignments = []
+        for index in self.indexes:
+            entry = index.lookup(email)
+            if entry is not None:
+                assignments.append(entry)
+        return {'email': email, 'assignments': assignments}
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections open between requests, and don't let Nagle's
+    # algorithm hold back the body after the headers
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != '/lookup' or 'email' not in query:
+            self.reply(400, {'error': 'Usage: GET /lookup?email=ADDRESS'})
+            return
+        answer = self.server.lookup.lookup(query['email'][0])
+        self.reply(200 if answer['assignments'] else 404, answer)
+
+    def reply(self, status: int, body: Dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, lookup: Lookup):
+        super().__init__(address, HTTPHandler)
+        self.lookup = lookup
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            email = line.decode().strip()
+            if not email:
+                continue
+            answer = self.server.lookup.lookup(email)
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+            self.wfile.flush()
+
+
+class SocketServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, lookup: Lookup):
+        super().__init__(path, SocketHandler)
+        self.lookup = lookup
+
+
+def remove_socket(path: str):
+    """
+    Remove a stale Unix socket at path. Refuses to remove anything which is
+    not a socket (such as a config file passed to --socket by mistake).
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError("Not removing %s: it is not a socket" % path)
+    os.unlink(path)
+
+
+def serve(paths: List[str], host: str = '127.0.0.1', port: int = 8025,
+        socket_path: Optional[str] = None):
+    """
+    Serve lookups for the configs at paths until interrupted, over a Unix
+    socket at socket_path if given, otherwise over HTTP at host:port.
+    """
+    lookup = Lookup(paths)
+    if socket_path:
+        remove_socket(socket_path)
+        server: socketserver.BaseServer = SocketServer(socket_path, lookup)
+        print("Listening on %s" % socket_path, flush=True)
+    else:
+        http_server = HTTPServer((host, port), lookup)
+        print("Listening on http://%s:%d/" % (host, http_server.server_port),
+            flush=True)
+        server = http_server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path:
+            remove_socket(socket_path)
@@ -1,14 +1,26 @@
 from sinterbot import config
 import ast
+import math
 import pathlib
 import shutil
 import re
 import sinterbot.algorithms as algo
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Iterator
 import logging
 # TODO enable/disable logging
 log = logging.getLogger(__name__)
 
+# derange() uses the MCMC sampler instead of rejection sampling when less
+# than this fraction of random permutations are expected to be accepted
+MCMC_THRESHOLD = 1e-3
+
+# Sharded configs with at least this many santas are deranged in parallel
+# worker processes (below it the process startup costs more than it saves)
+PARALLEL_MIN_SANTAS = 5000
+
+# Mean radius of the earth in km, for shipping distances between santas
+EARTH_RADIUS = 6371.0
+
 class ParseError(Exception):
     """Used for exceptions raised during parsing"""
     def __init__(self, lineno: int):
@@ -23,6 +35,24 @@ class ValidateError(Exception):
         return self.msg
 
 
+def parse_bool(val: str) -> Optional[bool]:
+    """Returns the boolean value of a config option, or None if invalid"""
+    val = val.strip().casefold()
+    if val in ("true", "yes", "1"):
+        return True
+    if val in ("false", "no", "0"):
+        return False
+    return None
+
+
+def parse_int(val: str) -> Optional[int]:
+    """Returns the integer value of a config option, or None if invalid"""
+    try:
+        return int(val)
+    except ValueError:
+        return None
+
+
 Blacklist_T = List[Tuple[str, str]]
 class Blacklist:
     def __init__(self):
@@ -58,10 +88,94 @@ class Blacklist:
     def add_emails(self, emails: Tuple[str, str]):
         self.list.append(emails)
 
+def distance(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """Returns the great circle distance in km between two (lat, lon) points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = (math.sin((lat2-lat1)/2)**2 +
+            math.cos(lat1) * math.cos(lat2) * math.sin((lon2-lon1)/2)**2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def project(locs: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """
+    Returns the (lat, lon) points in locs projected onto a plane in km (an
+    equirectangular projection about their mean latitude), which is close
+    enough to find each santa's nearest neighbours.
+    """
+    scale = math.cos(math.radians(sum(lat for lat, lon in locs) / len(locs)))
+    return [(math.radians(lon) * scale * EARTH_RADIUS,
+        math.radians(lat) * EARTH_RADIUS) for lat, lon in locs]
+
+
+def choose_engine(n: int, m: int, bl: algo.Blacklist, chain: bool = False,
+        gifts: int = 1, mincost: bool = False) -> str:
+    """
+    Returns the name of the function in sinterbot.algorithms which
+    derange_group() uses for a group of n santas.
+
+    If the constraints rule out so many permutations that rejection
+    sampling would be slow (see MCMC_THRESHOLD), the MCMC sampler is used
+    instead of constrained().
+    """
+    if mincost:
+        return 'mincost'
+    if chain:
+        return 'chain'
+    if gifts > 1:
+        return 'disjoint'
+    if algo.estimate_acceptance(n, m, bl) < MCMC_THRESHOLD:
+        return 'mcmc'
+    return 'constrained'
+
+
+def derange_group(n: int, m: int, bl: algo.Blacklist, chain: bool = False,
+        gifts: int = 1, mixing: Optional[int] = None,
+        locs: Optional[List[Tuple[float, float]]] = None) -> List[List[int]]:
+    """
+    Derange a group of n santas with the engine picked by choose_engine().
+    If the (lat, lon) location of each santa is given in locs, a random
+    assignment with a short total shipping distance is picked instead.
+    Returns one derangement per gift, or [] if the constraints could not be
+    satisfied.
+    """
+    engine = choose_engine(n, m, bl, chain, gifts, locs is not None)
+    if engine == 'mincost':
+        assert locs is not None  # make mypy happy
+        perm = algo.mincost(project(locs), m, bl,
+                lambda i, j: distance(locs[i], locs[j]))
+        if perm:
+            log.info("Total shipping distance: %.0f km" %
+                    sum(distance(locs[i], locs[j]) for i, j in enumerate(perm)))
+        return [perm] if perm else []
+    if engine == 'disjoint':
+        return algo.disjoint(n, gifts, m, bl, MCMC_THRESHOLD)
+    perm = []
+    if engine == 'constrained':
+        # Give up on rejection sampling after about 10 times the expected
+        # number of shuffles (the estimate can be far too optimistic, for
+        # example when the constraints are impossible) and fall back to MCMC
+        accept = algo.estimate_acceptance(n, m, bl)
+        perm = algo.DerangementSampler(n, m, bl).sample(int(10/accept))
+        if not perm:
+            log.info("Rejection sampling failed, trying the MCMC sampler")
+            engine = 'mcmc'
+    if engine == 'chain':
+        perm = algo.chain(n, bl)
+    elif engine == 'mcmc':
+        stats = algo.MCMCStats()
+        perm = algo.mcmc(n, m, bl, mixing, stats)
+        log.info("Used MCMC sampler: %d steps, acceptance rate %.3f, %d swaps, %d rotations, %d santas moved from the seed matching (degree %d)" % (
+            stats.steps, stats.acceptance_rate, stats.swaps, stats.rotations,
+            stats.moved, stats.seed_degree))
+    return [perm] if perm else []
+
+
 class Santa:
-    def __init__(self, name, email):
+    def __init__(self, name, email, group=None, loc=None):
         self.name = name
         self.email = email
+        self.group = group  # optional group (e.g. region) tag
+        self.loc = loc  # optional (lat, lon) location
 
     def __repr__(self):
         return "%s %s <%s>" % (self.__class__, self.name, self.email)
@@ -84,6 +198,9 @@ class SantaList:
         #TODO allow getting by email address str?
         return self.santas[key]
 
+    def __iter__(self) -> Iterator[Santa]:
+        return iter(self.santas)
+
     def emails(self):
         """Return list of all santa emails"""
         emails = []
@@ -102,11 +219,27 @@ class SinterConf:
         self.path = path
 
         # Set defaults
-        self.derangement: Optional[algo.Permutation] = None
+        # one derangement per gift (see also the derangement property)
+        self.derangements: List[algo.Permutation] = []
+        self.gifts = 1  # number of gifts each santa gives
+        self.sharded = False  # only assign santas within their group
         self.mincycle = 2  # minimum cycle length constraint
+        self.chain = False  # assign everybody in a single cycle
+        self.mincost = False  # keep shipping distances short
+        self.mixing: Optional[int] = None  # MCMC steps (None for default)
         self.santas = SantaList()
         self.bl = Blacklist()
 
+    @property
+    def derangement(self) -> Optional[algo.Permutation]:
+        """The derangement of the first gift, or None if not deranged yet"""
+        return self.derangements[0] if self.derangements else None
+
+    @derangement.setter
+    def derangement(self, perm: Optional[algo.PermLike]):
+        """Replaces all of the derangements with perm (a single gift)"""
+        self.derangements = [] if perm is None else [algo.Permutation(perm)]
+
     @staticmethod
     def parse_and_validate(path: str):
         """Factory which parses and validates the config file at path"""
@@ -120,24 +253,103 @@ class SinterConf:
         Returns blacklist (list of tuple of email addresses) as a
         algorithms.Blacklist (list of tuple of integers)
         """
-        emails = self.santas.emails()
+        index = {email: i for i, email in enumerate(self.santas.emails())}
         numeric = []
         for pair in self.bl.list:
-            numeric.append((emails.index(pair[0]), emails.index(pair[1])))
+            numeric.append((index[pair[0]], index[pair[1]]))
         return numeric
 
+    def engine(self) -> str:
+        """
+        Returns the name of the function in sinterbot.algorithms which
+        derange() uses for this config (see choose_engine()).
+        """
+        return choose_engine(len(self.santas), self.mincycle,
+                self.bl_to_numeric(), self.chain, self.gifts, self.mincost)
+
+    def locations(self) -> Optional[List[Tuple[float, float]]]:
+        """
+        Returns the location of every santa if assignments should keep
+        shipping distances short, otherwise None.
+        """
+        if not self.mincost:
+            return None
+        return [santa.loc for santa in self.santas]
+
+    def shards(self) -> List[List[int]]:
+        """
+        Returns the indices of the santas in each group (santas without a
+        group tag form a group of their own).
+        """
+        shards: Dict[Optional[str], List[int]] = {}
+        for i, santa in enumerate(self.santas):
+            shards.setdefault(santa.group, []).append(i)
+        return list(shards.values())
+
     def derange(self) -> Optional[algo.Permutation]:
         """
         Creates a derangment of santas and stores it in the derangement
         instance variable. You must call parse() and should call validate() (or
         parse_and_validate()) before creating the derangement.
+
+        If the config is sharded, each group is deranged separately (in
+        parallel for large configs) and the results are merged.
+
+        Raises ValidateError (and leaves any previous derangement in place)
+        if no derangement satisfying the constraints was found.
         """
         n = len(self.santas)
         if n < 2: return None
-        bl = self.bl_to_numeric()
-        self.derangement = algo.constrained(n, self.mincycle, bl)
+        if self.sharded:
+            perms = self.derange_shards()
+        else:
+            perms = derange_group(n, self.mincycle, self.bl_to_numeric(),
+                    self.chain, self.gifts, self.mixing, self.locations())
+        if not perms:
+            raise ValidateError("Could not find a derangement which satisfies the constraints")
+        self.derangements = [algo.Permutation(p) for p in perms]
         return self.derangement
 
+    def derange_shards(self) -> List[List[int]]:
+        """
+        Derange every group with its own share of the blacklist and merge the
+        results into one derangement per gift (or [] on failure).
+        """
+        n = len(self.santas)
+        shards = self.shards()
+        shard_of = [0] * n
+        local = [0] * n     # index of each santa within its shard
+        for s, members in enumerate(shards):
+            for l, g in enumerate(members):
+                shard_of[g] = s
+                local[g] = l
+
+        # blacklist pairs in different shards can never be assigned anyway
+        bls: List[algo.Blacklist] = [[] for s in shards]
+        for a, b in self.bl_to_numeric():
+            if shard_of[a] == shard_of[b]:
+                bls[shard_of[a]].append((local[a], local[b]))
+
+        locs = self.locations()
+        args = [(len(members), self.mincycle, bl, self.chain, self.gifts,
+            self.mixing, [locs[g] for g in members] if locs else None)
+            for members, bl in zip(shards, bls)]
+        if n >= PARALLEL_MIN_SANTAS and len(shards) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor() as pool:
+                results = list(pool.map(derange_group, *zip(*args)))
+        else:
+            results = [derange_group(*a) for a in args]
+
+        perms = [[0] * n for r in range(self.gifts)]
+        for members, result in zip(shards, results):
+            if not result:
+                return []
+            for perm, shard_perm in zip(perms, result):
+                for l, g in enumerate(members):
+                    perm[g] = members[shard_perm[l]]
+        return perms
+
     def save_derangement(self):
         """
         Save the derangement to the config file, first calling `derange()` if
@@ -153,12 +365,17 @@ class SinterConf:
         spath = pathlib.Path(self.path).expanduser()
         dpath = pathlib.Path(self.path + ".deranged").expanduser()
         deranged_re = re.compile(r'^\s*derangement:')
+        if self.gifts > 1:
+            # all derangements are saved as a list of lists on one line
+            saved = repr(self.derangements)
+        else:
+            saved = repr(self.derangement)
         with spath.open(mode='r') as src:
             with dpath.open(mode='w') as dest:
                 for line in src:
                     if deranged_re.match(line) is None:
                         dest.write(line)
-                dest.write("derangement:%s" % repr(self.derangement))
+                dest.write("derangement:%s" % saved)
         shutil.move(dpath, spath)
 
     def get_assignments(self) -> Dict[Santa, Santa]:
@@ -175,6 +392,33 @@ class SinterConf:
             assignment[self.santas[santa]] = self.santas[recipient]
         return assignment
 
+    def iter_assignments(self) -> Iterator[Tuple[Santa, Santa]]:
+        """
+        Yields a (santa, recipient) pair for every assignment, one santa at a
+        time (a santa giving several gifts is yielded once per recipient),
+        without building the whole assignment dict. If self.derangement is
+        empty, iter_assignments will first call derange() to populate it.
+        """
+        if self.derangement is None:
+            self.derange()
+        for i, santa in enumerate(self.santas):
+            for perm in self.derangements:
+                yield santa, self.santas[perm[i]]
+
+    def get_all_assignments(self) -> Dict[Santa, List[Santa]]:
+        """
+        Returns a dict mapping each santa to the list of all their recipients
+        (one per gift). If self.derangement is empty, get_all_assignments
+        will first call derange() to populate it.
+        """
+        if self.derangement is None:
+            self.derange()
+        assignment: Dict[Santa, List[Santa]] = {santa: [] for santa in self.santas}
+        for perm in self.derangements:
+            for santa, recipient in enumerate(perm):
+                assignment[self.santas[santa]].append(self.santas[recipient])
+        return assignment
+
     def validate(self):
         """
         Raises an exception of type ValidateError (with informative __str__) if
@@ -192,6 +436,28 @@ class SinterConf:
         if self.mincycle > n:
             raise ValidateError("mincycle (%d) is greater than number of santas (%d)." % (self.mincycle, n))
 
+        if self.gifts < 1 or self.gifts > n-1:
+            raise ValidateError("gifts (%d) must be between 1 and the number of santas minus one (%d)." % (self.gifts, n-1))
+
+        if self.gifts > 1 and self.chain:
+            raise ValidateError("chain can not be used with more than one gift per santa")
+
+        if self.mincost:
+            if self.chain or self.gifts > 1:
+                raise ValidateError("mincost can not be used with chain or more than one gift per santa")
+            for santa in self.santas:
+                if santa.loc is None:
+                    raise ValidateError("mincost needs a location for every santa: %s has none" % santa)
+
+        groups = None
+        if self.sharded:
+            groups = [santa.group for santa in self.santas]
+            for members in self.shards():
+                size = len(members)
+                group = self.santas[members[0]].group
+                if size < max(2, self.mincycle) or size <= self.gifts:
+                    raise ValidateError("Group %s has too few santas (%d) for the constraints" % (group, size))
+
         # make sure all santas have unique email addresses
         emails = self.santas.emails()
         unique_emails = set(emails)
@@ -201,27 +467,62 @@ class SinterConf:
         # make sure the black list contains only email addresses listed as santas
         for pair in self.bl.list:
             for email in pair:
-                if email.casefold() not in self.santas.emails():
+                if email.casefold() not in unique_emails:
                     raise ValidateError("Black list contains email not listed in santas: %s" % email)
 
         # validate derangement against constraints
         if self.derangement:
-            if len(self.derangement) != len(self.santas):
-                raise ValidateError("Derangement length does not match length of santa list")
-
-            try:
-                valid = algo.check_constraints(self.derangement, self.mincycle,
-                    self.bl_to_numeric())
-            except ValueError:
-                # something wrong with derangement values
-                raise ValidateError("Derangement fails validation: %s" %
-                        repr(self.derangement))
-            if not valid:
-                raise ValidateError("Derangement fails validation: %s" %
-                        repr(self.derangement))
+            if len(self.derangements) != self.gifts:
+                raise ValidateError("Number of derangements (%d) does not match number of gifts (%d)" % (len(self.derangements), self.gifts))
+
+            numeric = self.bl_to_numeric()
+            used = set()
+            for perm in self.derangements:
+                if len(perm) != len(self.santas):
+                    raise ValidateError("Derangement length does not match length of santa list")
+
+                try:
+                    valid = algo.check_constraints(perm, self.mincycle,
+                        numeric, groups)
+                except ValueError:
+                    # something wrong with derangement values
+                    raise ValidateError("Derangement fails validation: %s" %
+                            repr(perm))
+                if not valid:
+                    raise ValidateError("Derangement fails validation: %s" %
+                            repr(perm))
+                if self.chain and self.sharded:
+                    # every cycle is within a group, so there must be one
+                    # cycle per group
+                    if len(algo.decompose(perm)) != len(self.shards()):
+                        raise ValidateError("Derangement is not a single chain per group: %s" %
+                                repr(perm))
+                elif self.chain and not algo.check_single_cycle(perm):
+                    raise ValidateError("Derangement is not a single chain: %s" %
+                            repr(perm))
+
+                # no santa may give to the same recipient twice
+                edges = set(enumerate(perm))
+                if used & edges:
+                    raise ValidateError("Derangements assign the same recipient more than once: %s" %
+                            repr(perm))
+                used |= edges
 
         # TODO: validate constraints allow for at least 1 valid derangement!
 
+    @staticmethod
+    def parse_loc(val: str, lineno: int) -> Tuple[float, float]:
+        """Parses a santa location given as "latitude/longitude" in degrees"""
+        try:
+            lat, lon = (float(x) for x in val.split('/'))
+        except ValueError:
+            log.error("Invalid location on line %d: %s" % (lineno, val))
+            raise ParseError(lineno)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            log.error("Location out of range on line %d: %s" % (lineno, val))
+            raise ParseError(lineno)
+        return lat, lon
+
     def parse(self):
         """Parses the file at self.path and populates instance variables.
 
@@ -239,18 +540,82 @@ class SinterConf:
             # Get the value for each type of line
             prefix, val = kv.key.casefold(), kv.value
             if prefix == "mincycle":
-                self.mincycle = int(val)
+                value = parse_int(val)
+                if value is None:
+                    log.error("Invalid value for mincycle on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.mincycle = value
+            elif prefix == "sharded":
+                sharded = parse_bool(val)
+                if sharded is None:
+                    log.error("Invalid value for sharded on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.sharded = sharded
+            elif prefix == "gifts":
+                value = parse_int(val)
+                if value is None:
+                    log.error("Invalid value for gifts on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.gifts = value
+            elif prefix == "mixing":
+                value = parse_int(val)
+                if value is None:
+                    log.error("Invalid value for mixing on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.mixing = value
+            elif prefix == "mincost":
+                mincost = parse_bool(val)
+                if mincost is None:
+                    log.error("Invalid value for mincost on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.mincost = mincost
+            elif prefix == "chain":
+                chain = parse_bool(val)
+                if chain is None:
+                    log.error("Invalid value for chain on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
+                self.chain = chain
             elif prefix == "!":
                 # black lists are given as comma separated pairs with
                 # optional space after comma
                 # "email1@domain.tld,email2@domain.tld"
-                first, second = val.split(',', 2)
+                try:
+                    first, second = val.split(',', 2)
+                except ValueError:
+                    log.error("Invalid blacklist pair on line %d: %s" % (kv.lineno, val))
+                    raise ParseError(kv.lineno)
                 second = second.strip()
                 self.bl.add_emails((first, second))
             elif prefix == "derangement":
-                self.derangement = ast.literal_eval(val)
-                if not isinstance(self.derangement, list):
+                try:
+                    saved = ast.literal_eval(val)
+                except (ValueError, SyntaxError):
+                    saved = None
+                if not isinstance(saved, list):
+                    log.error("Invalid derangement on line %d" % kv.lineno)
+                    raise ParseError(kv.lineno)
+                if not (saved and isinstance(saved[0], list)):
+                    saved = [saved]
+                try:
+                    # one derangement per gift
+                    self.derangements = [algo.Permutation(p) for p in saved]
+                except ValueError:
+                    log.error("Derangement on line %d is not a permutation" % kv.lineno)
                     raise ParseError(kv.lineno)
             else:
-                # no pre-defined prefix, assume this is a santa name
-                self.santas.add(Santa(kv.key, val))
+                # no pre-defined prefix, assume this is a santa name. The
+                # email may be followed by comma separated attributes:
+                # "Name: email@domain.tld, group=emea, loc=52.52/13.40"
+                fields = val.split(',')
+                santa = Santa(kv.key, fields[0].strip())
+                for field in fields[1:]:
+                    attr, sep, attrval = field.partition('=')
+                    attr = attr.strip().casefold()
+                    if attr == "group" and sep:
+                        santa.group = attrval.strip()
+                    elif attr == "loc" and sep:
+                        santa.loc = self.parse_loc(attrval, kv.lineno)
+                    else:
+                        log.error("Unknown santa attribute on line %d: %s" % (kv.lineno, field))
+                        raise ParseError(kv.lineno)
+                self.santas.add(santa)
@@ -1,6 +1,9 @@
 import sinterbot.algorithms as algo
 import unittest
 from collections import defaultdict
+import itertools
+import math
+import random
 import ast
 
 class TestFunctions(unittest.TestCase):
@@ -31,6 +34,90 @@ class TestFunctions(unittest.TestCase):
             d[repr(p)] += 1
         self.assertEqual(12, len(d.keys()))
 
+    def test_sampler(self):
+        bl = [(0, 1), (2, 5)]
+        sampler = algo.DerangementSampler(8, 3, bl, random.Random(1))
+        perms = list(itertools.islice(sampler.samples(), 200))
+        for p in perms:
+            self.assertTrue(algo.check_constraints(p, 3, bl))
+        self.assertGreater(len(set(map(tuple, perms))), 100)
+        self.assertGreaterEqual(sampler.shuffles, 200)
+        # the same seed gives the same samples
+        again = algo.DerangementSampler(8, 3, bl, random.Random(1))
+        self.assertEqual(again.sample(), perms[0])
+        # impossible constraints
+        self.assertEqual(algo.DerangementSampler(2, 2, [(0, 1)]).sample(100), [])
+        self.assertEqual(list(algo.DerangementSampler(3, 4).samples()), [])
+
+    def test_sattolo(self):
+        """Test that sattolo generates all 24 5-cycles and nothing else"""
+        d = defaultdict(int)
+        for i in range(1000):
+            p = algo.sattolo(5)
+            self.assertTrue(algo.check_single_cycle(p))
+            d[repr(p)] += 1
+        self.assertEqual(24, len(d.keys()))
+
+    def test_chain(self):
+        bl = [(0,1), (2,3), (4,0)]
+        d = defaultdict(int)
+        for i in range(1000):
+            p = algo.chain(6, bl)
+            self.assertTrue(algo.check_single_cycle(p))
+            self.assertTrue(algo.check_blacklist(p, bl))
+            d[repr(p)] += 1
+        # 6-cycles which avoid bl (counted by brute force)
+        self.assertEqual(28, len(d.keys()))
+        # There is no 3-cycle which avoids both directions of (0,1)
+        self.assertEqual(algo.chain(3, [(0,1)]), [])
+
+    def test_mcmc(self):
+        """Test that the MCMC sampler reaches all 12 valid permutations"""
+        d = defaultdict(int)
+        stats = algo.MCMCStats()
+        for i in range(1000):
+            p = algo.mcmc(5, 3, [(0,1)], stats=stats)
+            self.assertTrue(algo.check_constraints(p, 3, [(0,1)]))
+            d[repr(p)] += 1
+        self.assertEqual(12, len(d.keys()))
+        self.assertGreater(stats.acceptance_rate, 0)
+        self.assertEqual(stats.steps, algo.mixing_steps(5))
+
+    def test_mcmc_dense(self):
+        """Test the MCMC sampler when every family of 8 is blacklisted"""
+        n = 40
+        bl = [(i, j) for i in range(n) for j in range(i+1, n) if i//8 == j//8]
+        self.assertLess(algo.estimate_acceptance(n, 3, bl), 1e-3)
+        p = algo.mcmc(n, 3, bl)
+        self.assertTrue(algo.check_constraints(p, 3, bl))
+        # impossible constraints
+        self.assertEqual(algo.mcmc(3, 2, [(0,1)]), [])
+
+    def test_mincost(self):
+        points = [(random.random(), random.random()) for i in range(500)]
+        bl = [(0, 1), (2, 3)]
+        perm = algo.mincost(points, 3, bl)
+        self.assertTrue(algo.check_constraints(perm, 3, bl))
+        total = sum(math.dist(points[i], points[j]) for i, j in enumerate(perm))
+        uniform = algo.constrained(500, 3, bl)
+        self.assertLess(total, sum(math.dist(points[i], points[j])
+            for i, j in enumerate(uniform)) / 5)
+
+    def test_disjoint(self):
+        """Test that k derangements never repeat a giver -> recipient pair"""
+        bl = [(0,1)]
+        for n, k, m in [(5, 3, 2), (8, 4, 3), (60, 20, 3)]:
+            perms = algo.disjoint(n, k, m, bl)
+            self.assertEqual(len(perms), k)
+            used = set()
+            for p in perms:
+                self.assertTrue(algo.check_constraints(p, m, bl))
+                edges = set(enumerate(p))
+                self.assertFalse(used & edges)
+                used |= edges
+        # santa 0 may only give to 2, 3 or 4
+        self.assertEqual(algo.disjoint(5, 4, 2, bl), [])
+
 class TestUtilities(unittest.TestCase):
 
     oeis_dn = [1, 0, 1, 2, 9, 44, 265, 1854, 14833, 133496, 1334961, 14684570, 176214841, 2290792932, 32071101049, 481066515734, 7697064251745, 130850092279664, 2355301661033953, 44750731559645106, 895014631192902121, 18795307255050944540, 413496759611120779881, 9510425471055777937262]
@@ -51,5 +138,75 @@ class TestUtilities(unittest.TestCase):
         for k, v in gold.items():
             self.assertEqual(algo.decompose(k), v)
 
+    def test_nearest_neighbours(self):
+        points = [(random.random(), random.random()) for i in range(300)]
+        near = algo.nearest_neighbours(points, 5)
+        for i in range(300):
+            brute = sorted(range(300), key=lambda j: math.dist(points[i], points[j]))
+            self.assertEqual(near[i], brute[1:6])
+        self.assertEqual(algo.nearest_neighbours([(0, 0), (0, 0)], 5), [[1], [0]])
+        self.assertEqual(algo.nearest_neighbours(points, 5, [7, 3]), [near[7], near[3]])
+
+    def test_hopcroft_karp(self):
+        adj = [[1, 2], [0], [1]]
+        p = algo.hopcroft_karp(3, adj)
+        self.assertEqual(p, [2, 0, 1])
+        self.assertIsNone(algo.hopcroft_karp(3, [[1], [0], [1]]))
+        self.assertEqual(algo.max_matching(3, [[1], [0], [1]]).count(-1), 1)
+        self.assertEqual(algo.max_matching(3, adj, [-1, 0, -1]), [2, 0, 1])
+
+    def test_widen_unmatched(self):
+        """Test that only the unmatched santas get new, nearby edges"""
+        points = [(i, 0) for i in range(6)] + [(100, 0)]
+        # nobody may give to the far away santa 6
+        adj = [[j for j in algo.nearest_neighbours(points, 2)[i] if j != 6]
+                for i in range(7)]
+        before = [list(a) for a in adj]
+        matching = algo.max_matching(7, adj)
+        self.assertEqual(matching.count(-1), 1)
+        algo.widen_unmatched(points, adj, set(), matching, 3)
+        for i in range(7):
+            added = set(adj[i]) - set(before[i])
+            if matching[i] != -1:
+                self.assertLessEqual(added, {6})
+        self.assertIsNotNone(algo.hopcroft_karp(7, adj))
+        self.assertLess(sum(map(len, adj)) - sum(map(len, before)), 6)
+
+    def test_check_single_cycle(self):
+        self.assertTrue(algo.check_single_cycle([1, 2, 3, 4, 0]))
+        self.assertFalse(algo.check_single_cycle([1, 0, 3, 4, 2]))
+        self.assertFalse(algo.check_single_cycle([0, 2, 1]))
+
+    def test_check_constraints_groups(self):
+        groups = ['a', 'a', 'b', 'b']
+        self.assertTrue(algo.check_constraints([1, 0, 3, 2], 2, [], groups))
+        self.assertFalse(algo.check_constraints([2, 3, 0, 1], 2, [], groups))
+        self.assertFalse(algo.check_constraints([1, 0, 3, 2], 2, [(0, 1)], groups))
+
     def test_check_deranged(self):
         self.assertFalse(algo.check_deranged([0,2,1,4,3]))
+
+
+class TestPermutation(unittest.TestCase):
+    def test_bijection(self):
+        self.assertEqual(algo.Permutation([4, 3, 0, 1, 2]), [4, 3, 0, 1, 2])
+        for bad in ([1, 1, 0], [0, 3, 1], [-1, 0]):
+            with self.assertRaises(ValueError):
+                algo.Permutation(bad)
+        with self.assertRaises(ValueError):
+            algo.check_constraints([1, 1, 0], 2, None)
+
+    def test_cached(self):
+        p = algo.Permutation([4, 3, 0, 1, 2])
+        self.assertEqual(p.inverse(), [2, 3, 4, 1, 0])
+        self.assertIs(p.inverse().inverse(), p)
+        self.assertEqual(p.cycles(), algo.decompose([4, 3, 0, 1, 2]))
+        self.assertEqual(p.min_cycle(), 2)
+        self.assertTrue(algo.check_constraints(p, 2, None))
+        self.assertFalse(algo.check_constraints(p, 3, None))
+
+    def test_repr(self):
+        p = algo.Permutation([1, 2, 0])
+        self.assertEqual(repr(p), "[1, 2, 0]")
+        self.assertEqual(p[1:], [2, 0])
+        self.assertEqual(list(p), [1, 2, 0])
@@ -0,0 +1,79 @@
+import unittest
+import itertools
+import math
+
+try:
+    import sinterbot.audit as audit
+except ImportError:
+    audit = None  # numpy not installed
+import sinterbot.algorithms as algo
+
+
+@unittest.skipIf(audit is None, "audit requires numpy")
+class TestAudit(unittest.TestCase):
+    def test_rank(self):
+        """Test that rank() numbers permutations in lexicographic order"""
+        for i, p in enumerate(itertools.permutations(range(5))):
+            self.assertEqual(audit.rank(p), i)
+
+    def test_chi2_sf(self):
+        # 95th percentiles of the chi-square distribution
+        self.assertAlmostEqual(audit.chi2_sf(3.841, 1), 0.05, places=3)
+        self.assertAlmostEqual(audit.chi2_sf(18.307, 10), 0.05, places=3)
+        self.assertAlmostEqual(audit.chi2_sf(124.342, 100), 0.05, places=3)
+
+    def test_uniform(self):
+        """Test that samples from a uniform generator pass the audit"""
+        gen = audit.Generator('constrained', 5, 3, [(0, 1)])
+        result = audit.sample_chunk(gen, 5000, seed=1)
+        stat, dof, p = result.chisquare()
+        self.assertEqual(result.total, 5000)
+        self.assertEqual(result.invalid, 0)
+        self.assertEqual(dof, 11)
+        self.assertGreater(p, 1e-4)
+
+    def test_uniform_9(self):
+        """
+        Test that a uniform generator passes at n=9, which is counted
+        exactly by rank (hash buckets used to split its assignments unevenly)
+        """
+        result = audit.run(9, 2, samples=50000, jobs=2, seed=1)
+        self.assertTrue(result.exact)
+        stat, dof, p = result.chisquare()
+        self.assertEqual(dof, algo.Dn(9) - 1)
+        self.assertGreater(p, 1e-3)
+
+    def test_bucket_count(self):
+        """Test that fewer buckets are used when samples approach the support"""
+        self.assertEqual(audit.bucket_count(20, 3, [], 10**6), audit.BUCKETS)
+        self.assertLess(audit.bucket_count(11, 3, [(0, 1)], 10**5), 1024)
+        self.assertEqual(audit.bucket_count(11, 3, [], 10**9), 2)
+
+    def test_chain(self):
+        """Test that chains avoiding a sparse blacklist are uniform"""
+        gen = audit.Generator('chain', 6, bl=[(0, 1), (2, 3)])
+        result = audit.sample_chunk(gen, 20000, seed=1)
+        stat, dof, p = result.chisquare()
+        self.assertEqual(result.invalid, 0)
+        self.assertGreater(p, 1e-4)
+
+    def test_biased(self):
+        """Test that the biased backtracking generator fails the audit"""
+        gen = audit.Generator('generate_backtrack', 6)
+        result = audit.sample_chunk(gen, 20000, seed=1)
+        stat, dof, p = result.chisquare()
+        self.assertEqual(dof, algo.Dn(6) - 1)
+        self.assertLess(p, 1e-4)
+
+    def test_run(self):
+        """Test that hashed counts from several workers are merged"""
+        result = audit.run(12, 3, samples=3000, jobs=2, seed=1)
+        self.assertEqual(result.total, 3000)
+        self.assertFalse(result.exact)
+        self.assertEqual(result.counts.sum(), 3000)
+        self.assertEqual(result.marginals.sum(), 3000 * 12)
+        self.assertIn("Hash buckets", result.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
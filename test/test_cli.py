@@ -0,0 +1,250 @@
+import unittest
+import csv
+import importlib.util
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import pathlib
+
+import bin.sinterbot as cli
+
+TESTDIR = 'test/'
+
+
+def run_cli(*args):
+    """Run the sinterbot command line tool and return the CompletedProcess"""
+    return subprocess.run([sys.executable, '-m', 'bin.sinterbot'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+
+
+def import_times(*args):
+    """
+    Run the command line tool under `python -X importtime` and return a dict
+    mapping each imported module to its self import time in microseconds.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m',
+        'bin.sinterbot'] + list(args), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'): continue
+        selftime, cumulative, module = line[len('import time:'):].split('|')
+        if not selftime.strip().isdigit(): continue  # header line
+        times[module.strip()] = int(selftime)
+    return times
+
+
+class TestStartup(unittest.TestCase):
+    # Generous budgets (total microseconds spent importing modules, including
+    # the interpreter's own startup imports) so that a slow CI machine does
+    # not fail, but a subcommand that starts importing something heavy will.
+    BUDGET_US = {
+        'check': 250000,
+        'view': 250000,
+        'derange': 250000,
+        'send': 400000,
+        'export': 250000,
+        'serve': 250000,
+        # numpy alone takes most of this
+        'audit': 1000000,
+    }
+
+    # Modules which only `send` needs
+    SEND_ONLY = ['smtplib', 'email.message', 'datetime',
+            'sinterbot.smtpconf']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = str(pathlib.Path(self.tmpdir) / 'test.conf')
+        shutil.copy(TESTDIR+'test.conf', self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assert_budget(self, subcommand, times):
+        total = sum(times.values())
+        self.assertLess(total, self.BUDGET_US[subcommand],
+                "`%s` spent %dus importing modules" % (subcommand, total))
+
+    def test_check(self):
+        times = import_times('check', TESTDIR+'test.conf')
+        self.assert_budget('check', times)
+        for module in self.SEND_ONLY + ['concurrent.futures']:
+            self.assertNotIn(module, times)
+
+    def test_view(self):
+        times = import_times('view', TESTDIR+'test.conf')
+        self.assert_budget('view', times)
+        for module in self.SEND_ONLY:
+            self.assertNotIn(module, times)
+
+    def test_derange(self):
+        times = import_times('derange', self.path)
+        self.assertTrue(self.deranged())
+        self.assert_budget('derange', times)
+        self.assertIn('sinterbot.sinterconf', times)
+        # a single file is deranged without a process pool
+        for module in self.SEND_ONLY + ['concurrent.futures']:
+            self.assertNotIn(module, times)
+
+    def test_send(self):
+        # test.conf has no derangement so send returns before connecting
+        times = import_times('send', TESTDIR+'test.conf', '-c', 'smtpsample.conf')
+        self.assert_budget('send', times)
+        self.assertIn('smtplib', times)
+
+    def test_export(self):
+        run_cli('derange', self.path)
+        times = import_times('export', self.path, '-o', self.path + '.csv')
+        self.assert_budget('export', times)
+        self.assertIn('csv', times)
+        for module in self.SEND_ONLY:
+            self.assertNotIn(module, times)
+
+    def test_serve(self):
+        # serve refuses to replace a --socket path which is not a socket, so
+        # it exits right after importing everything it needs
+        run_cli('derange', self.path)
+        times = import_times('serve', self.path, '--socket', self.path)
+        self.assertTrue(self.deranged())
+        self.assert_budget('serve', times)
+        self.assertIn('sinterbot.serve', times)
+        # http.server needs email.message, but not smtplib
+        for module in ['smtplib', 'sinterbot.smtpconf']:
+            self.assertNotIn(module, times)
+
+    @unittest.skipIf(importlib.util.find_spec('numpy') is None, "numpy is not installed")
+    def test_audit(self):
+        times = import_times('audit', self.path, '-s', '100', '-j', '1')
+        self.assert_budget('audit', times)
+        self.assertIn('sinterbot.audit', times)
+        for module in ['smtplib', 'sinterbot.smtpconf']:
+            self.assertNotIn(module, times)
+
+    def deranged(self):
+        with open(self.path) as f:
+            return 'derangement:' in f.read()
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = self.tmpdir + '/test.conf'
+        shutil.copy(TESTDIR+'test.conf', self.path)
+        run_cli('derange', self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_csv(self):
+        out = self.tmpdir + '/out.csv'
+        result = run_cli('export', self.path, '-o', out)
+        self.assertEqual(result.returncode, 0)
+        with open(out, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(set(r['santa_email'] for r in rows),
+                set(r['recipient_email'] for r in rows))
+        for row in rows:
+            self.assertNotEqual(row['santa_email'], row['recipient_email'])
+
+    def test_ndjson_filter(self):
+        result = run_cli('export', self.path, '-f', 'ndjson', '-u', 'user2@email.tld')
+        self.assertEqual(result.returncode, 0)
+        rows = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['santa_email'], 'user2@email.tld')
+        self.assertNotIn(rows[0]['recipient_email'], ['user1@email.tld', 'user2@email.tld', 'user4@email.tld'])
+
+    def test_not_deranged(self):
+        result = run_cli('export', TESTDIR+'test.conf')
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout, '')
+
+
+class TestVerbose(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = self.tmpdir + '/dense.conf'
+        shutil.copy(TESTDIR+'dense.conf', self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mcmc_diagnostics(self):
+        """Test that -v shows the MCMC sampler statistics"""
+        result = run_cli('-v', 'derange', self.path)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("Used MCMC sampler:", result.stderr)
+        result = run_cli('derange', '--force', self.path)
+        self.assertNotIn("Used MCMC sampler:", result.stderr)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for i in range(3):
+            shutil.copy(TESTDIR+'test.conf', self.tmpdir + '/group%d.conf' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_derange_directory(self):
+        """Test that every config file in a directory is deranged"""
+        result = run_cli('derange', '-j', '2', self.tmpdir)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("3 file(s) processed, 0 failed.", result.stdout)
+        result = run_cli('check', self.tmpdir)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.count("Valid derangement found."), 3)
+
+    def test_failed_file(self):
+        """Test that one bad file fails the batch but not the other files"""
+        shutil.copy(TESTDIR+'bigm.conf', self.tmpdir)
+        result = run_cli('derange', self.tmpdir)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("4 file(s) processed, 1 failed.", result.stdout)
+        self.assertIn("bigm.conf: FAIL", result.stdout)
+        for i in range(3):
+            text = pathlib.Path(self.tmpdir + '/group%d.conf' % i).read_text()
+            self.assertIn("derangement:", text)
+
+    def test_impossible_constraints(self):
+        """Test that a config which can't be deranged fails and is not modified"""
+        shutil.copy(TESTDIR+'impossible.conf', self.tmpdir)
+        path = self.tmpdir + '/impossible.conf'
+        before = pathlib.Path(path).read_text()
+        result = run_cli('derange', path)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("Could not find a derangement", result.stderr)
+        self.assertEqual(pathlib.Path(path).read_text(), before)
+        result = run_cli('derange', self.tmpdir)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("impossible.conf: FAIL", result.stdout)
+
+    def test_unexpected_error(self):
+        """Test that an unexpected error in one file does not abort the batch"""
+        shutil.copy(TESTDIR+'badint.conf', self.tmpdir)
+        result = run_cli('derange', '-j', '2', self.tmpdir)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("4 file(s) processed, 1 failed.", result.stdout)
+        self.assertIn("badint.conf: FAIL", result.stdout)
+        def fail(path):
+            raise ValueError("boom")
+        self.assertEqual(cli.run_one(fail, 'x.conf'), ('x.conf', False, "ValueError: boom"))
+
+    def test_empty_directory(self):
+        """Test that a directory without any config files is an error"""
+        empty = self.tmpdir + '/empty'
+        pathlib.Path(empty).mkdir()
+        for command in ('derange', 'check'):
+            result = run_cli(command, empty)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn("No *.conf files found", result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import unittest
 import shutil
 import sinterbot.sinterconf as config
 import sinterbot.smtpconf as smtpconfig
+import sinterbot.algorithms as algo
 
 TESTDIR = 'test/'
 
@@ -40,6 +41,121 @@ class TestParse(unittest.TestCase):
             c.parse()
         self.assertEqual(err.exception.line, 7)
 
+    def test_bad_int(self):
+        """Test that a mincycle which is not a number raises ParseError"""
+        with self.assertRaises(config.ParseError) as err:
+            config.SinterConf.parse_and_validate(TESTDIR+'badint.conf')
+        self.assertEqual(err.exception.line, 6)
+
+class TestChain(unittest.TestCase):
+    def setUp(self):
+        shutil.copy(TESTDIR+'chain.conf', TESTDIR+'chain.deranged')
+
+    def test_chain(self):
+        """Test that a chain config is deranged into a single cycle"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'chain.deranged')
+        self.assertTrue(c.chain)
+        c.derange()
+        c.save_derangement()
+        d = config.SinterConf.parse_and_validate(TESTDIR+'chain.deranged')
+        self.assertEqual(c.derangement, d.derangement)
+        self.assertEqual(len(algo.decompose(d.derangement)), 1)
+
+    def test_impossible_chain(self):
+        """Test that derange() raises when no chain avoids the blacklist"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'impossible.conf')
+        with self.assertRaises(config.ValidateError):
+            c.derange()
+        self.assertIsNone(c.derangement)
+
+    def test_bad_chain(self):
+        """Test that a derangement with several cycles fails in chain mode"""
+        with self.assertRaises(config.ValidateError):
+            config.SinterConf.parse_and_validate(TESTDIR+'badchain.conf')
+
+class TestGifts(unittest.TestCase):
+    def setUp(self):
+        shutil.copy(TESTDIR+'gifts.conf', TESTDIR+'gifts.deranged')
+
+    def test_gifts(self):
+        """Test that every santa is saved with three different recipients"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'gifts.deranged')
+        self.assertEqual(c.gifts, 3)
+        c.derange()
+        c.save_derangement()
+        d = config.SinterConf.parse_and_validate(TESTDIR+'gifts.deranged')
+        self.assertEqual(c.derangements, d.derangements)
+        self.assertEqual(d.derangement, d.derangements[0])
+        for santa, recipients in d.get_all_assignments().items():
+            self.assertEqual(len(set(recipients)), 3)
+            self.assertNotIn(santa, recipients)
+
+    def test_repeated_recipient(self):
+        """Test that derangements repeating a recipient fail validation"""
+        with self.assertRaises(config.ValidateError):
+            config.SinterConf.parse_and_validate(TESTDIR+'badgifts.conf')
+
+class TestSharded(unittest.TestCase):
+    def setUp(self):
+        shutil.copy(TESTDIR+'sharded.conf', TESTDIR+'sharded.deranged')
+
+    def test_sharded(self):
+        """Test that santas are only assigned within their group"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'sharded.deranged')
+        self.assertTrue(c.sharded)
+        self.assertEqual(c.santas[0].email, 'user1@email.tld')
+        self.assertEqual(c.shards(), [[0, 1, 2, 3], [4, 5, 6]])
+        for i in range(20):
+            c.derange()
+            c.validate()
+            for santa, recipient in c.get_assignments().items():
+                self.assertEqual(santa.group, recipient.group)
+        c.save_derangement()
+        d = config.SinterConf.parse_and_validate(TESTDIR+'sharded.deranged')
+        self.assertEqual(c.derangement, d.derangement)
+
+    def test_parallel(self):
+        """Test deranging the shards in worker processes"""
+        threshold = config.PARALLEL_MIN_SANTAS
+        config.PARALLEL_MIN_SANTAS = 0
+        try:
+            c = config.SinterConf.parse_and_validate(TESTDIR+'sharded.deranged')
+            c.derange()
+            c.validate()
+        finally:
+            config.PARALLEL_MIN_SANTAS = threshold
+        groups = [santa.group for santa in c.santas]
+        self.assertTrue(algo.check_constraints(c.derangement, 3, c.bl_to_numeric(), groups))
+
+    def test_cross_group(self):
+        """Test that a derangement crossing groups fails validation"""
+        with self.assertRaises(config.ValidateError):
+            config.SinterConf.parse_and_validate(TESTDIR+'badshard.conf')
+
+class TestMinCost(unittest.TestCase):
+    def setUp(self):
+        shutil.copy(TESTDIR+'mincost.conf', TESTDIR+'mincost.deranged')
+
+    def test_mincost(self):
+        """Test that santas are assigned within their city"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'mincost.deranged')
+        self.assertTrue(c.mincost)
+        self.assertEqual(c.santas[3].loc, (40.71, -74.01))
+        self.assertEqual(c.engine(), 'mincost')
+        for i in range(10):
+            c.derange()
+            c.validate()
+            for santa, recipient in c.get_assignments().items():
+                self.assertLess(config.distance(santa.loc, recipient.loc), 100)
+        c.save_derangement()
+        d = config.SinterConf.parse_and_validate(TESTDIR+'mincost.deranged')
+        self.assertEqual(c.derangement, d.derangement)
+
+    def test_missing_location(self):
+        """Test that mincost fails validation unless every santa has a location"""
+        with self.assertRaises(config.ValidateError):
+            config.SinterConf.parse_and_validate(TESTDIR+'badmincost.conf')
+
 class TestDerangeSave(unittest.TestCase):
     def setUp(self):
         # copy test.conf so we can modify it and test that it worked
@@ -65,6 +181,42 @@ class TestDerangeSave(unittest.TestCase):
             self.assertEqual(c.santas[i].email, d.santas[i].email)
         self.assertEqual(c.derangement, d.derangement)
 
+    def test_set_derangement(self):
+        """Test that setting derangement replaces what every accessor sees"""
+        c = config.SinterConf.parse_and_validate(TESTDIR+'test.deranged')
+        c.derange()
+        c.derangement = [1, 2, 3, 4, 0]
+        self.assertEqual(c.derangements, [c.derangement])
+        self.assertEqual(c.get_assignments()[c.santas[0]], c.santas[1])
+        self.assertEqual(dict(c.iter_assignments())[c.santas[0]], c.santas[1])
+        self.assertEqual(c.get_all_assignments()[c.santas[0]], [c.santas[1]])
+        with self.assertRaises(config.ValidateError):
+            c.validate()  # Santa A -> Santa B is blacklisted
+
+    def test_mcmc_derangement(self):
+        """Test that derange() switches to MCMC below the threshold"""
+        threshold = config.MCMC_THRESHOLD
+        config.MCMC_THRESHOLD = 1.0
+        try:
+            c = config.SinterConf.parse_and_validate(TESTDIR+'test.deranged')
+            c.derange()
+            c.validate()
+        finally:
+            config.MCMC_THRESHOLD = threshold
+        self.assertTrue(algo.check_constraints(c.derangement, 3, c.bl_to_numeric()))
+
+    def test_impossible_constraints(self):
+        """
+        Test that derange() raises, rather than shuffling forever, when no
+        derangement satisfies constraints that look easy to satisfy.
+        """
+        c = config.SinterConf.parse_and_validate(TESTDIR+'tight.conf')
+        self.assertEqual(config.choose_engine(len(c.santas), c.mincycle,
+            c.bl_to_numeric()), 'constrained')
+        with self.assertRaises(config.ValidateError):
+            c.derange()
+        self.assertIsNone(c.derangement)
+
     def test_wrong_derangement(self):
         """
         Test that a .deranged file with a wrong derangement fails validation.
@@ -72,6 +224,13 @@ class TestDerangeSave(unittest.TestCase):
         with self.assertRaises(config.ValidateError):
             config.SinterConf.parse_and_validate(TESTDIR+'badderangement.conf')
 
+    def test_not_permutation(self):
+        """
+        Test that a derangement which repeats a recipient fails to parse.
+        """
+        with self.assertRaises(config.ParseError):
+            config.SinterConf.parse_and_validate(TESTDIR+'notperm.conf')
+
     def test_missing_santa(self):
         """
         Test that a .deranged file with a missing santa fails validation.
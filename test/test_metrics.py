@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import unittest
+from unittest import mock
+
+import bin.sinterbot as cli
+import sinterbot.metrics as metrics
+import sinterbot.sinterconf as config
+
+TESTDIR = 'test/'
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        h = metrics.Histogram((0.1, 1.0))
+        for v in (0.05, 0.1, 0.5, 2.0):
+            h.observe(v)
+        self.assertEqual(h.cumulative(), [2, 3])
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 2.65)
+        self.assertEqual(h.quantile(0.5), 0.5)
+        self.assertEqual(h.summary()['max'], 2.0)
+
+
+class TestSendMetrics(unittest.TestCase):
+    def setUp(self):
+        self.m = metrics.SendMetrics()
+        for i in range(2):
+            with self.m.phase('connect'):
+                pass
+        self.m.message(0.02, 250)
+        self.m.message(0.3, 250)
+        self.m.message(0.01, 'disconnected', ok=False)
+        self.m.message(1.5, 451, ok=False)
+        self.m.finish()
+
+    def test_summary(self):
+        s = self.m.summary()
+        self.assertEqual(s['messages'], {'sent': 2, 'failed': 2})
+        self.assertEqual(s['responses'], {'250': 2, '451': 1, 'disconnected': 1})
+        self.assertEqual(s['message_seconds']['count'], 4)
+        self.assertEqual(s['phase_seconds']['connect']['count'], 2)
+        self.assertGreater(s['messages_per_second'], 0)
+
+    def test_prometheus(self):
+        lines = self.m.prometheus().splitlines()
+        self.assertIn('# TYPE sinterbot_send_message_seconds histogram', lines)
+        self.assertIn('sinterbot_send_message_seconds_bucket{le="0.025"} 2', lines)
+        self.assertIn('sinterbot_send_message_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('sinterbot_send_message_seconds_count 4', lines)
+        self.assertIn('sinterbot_send_phase_seconds_count{phase="connect"} 2', lines)
+        self.assertIn('sinterbot_send_responses_total{code="451"} 1', lines)
+
+    def test_reply_code(self):
+        self.assertEqual(metrics.reply_code(smtplib.SMTPDataError(554, b'no')), 554)
+        refused = smtplib.SMTPRecipientsRefused({'a@b': (550, b'unknown')})
+        self.assertEqual(metrics.reply_code(refused), 550)
+        self.assertEqual(metrics.reply_code(smtplib.SMTPServerDisconnected()), 'disconnected')
+        self.assertEqual(metrics.reply_code(TimeoutError()), 'timeout')
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP, dropping the connection once"""
+    connections = 0
+    sent = 0
+    password = 'secret'
+
+    def __init__(self, host, port=0, timeout=None):
+        FakeSMTP.connections += 1
+
+    def starttls(self): pass
+    def quit(self): pass
+
+    def login(self, user, password):
+        if password != FakeSMTP.password:
+            raise smtplib.SMTPAuthenticationError(535, b'bad credentials')
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        FakeSMTP.sent += 1
+        if FakeSMTP.sent == 2:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        if to_addrs == 'user5@email.tld':
+            raise smtplib.SMTPRecipientsRefused({to_addrs: (550, b'unknown user')})
+
+
+class TestSend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        shutil.copy(TESTDIR+'test.conf', self.path)
+        c = config.SinterConf.parse_and_validate(self.path)
+        c.save_derangement()
+        FakeSMTP.connections = FakeSMTP.sent = 0
+        self.prom = os.path.join(self.tmpdir, 'send.prom')
+        self.summary = os.path.join(self.tmpdir, 'send.json')
+        self.args = argparse.Namespace(path=self.path,
+                smtppath='smtpsample.conf', email=None,
+                metrics_prom=self.prom, metrics_json=self.summary)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_send_metrics(self):
+        """Test that the send loop counts a dropped connection and writes its metrics"""
+        with mock.patch('smtplib.SMTP', FakeSMTP), mock.patch('builtins.print'):
+            cli.send(self.args)
+        # the message is not resent after the disconnect
+        self.assertEqual(FakeSMTP.connections, 1)
+        self.assertEqual(FakeSMTP.sent, 5)
+        with open(self.summary) as f:
+            s = json.load(f)
+        self.assertEqual(s['messages'], {'sent': 3, 'failed': 2})
+        self.assertEqual(s['responses'], {'250': 3, '550': 1, 'disconnected': 1})
+        self.assertEqual(s['phase_seconds']['login']['count'], 1)
+        with open(self.prom) as f:
+            self.assertIn('sinterbot_send_messages_total{result="sent"} 3\n', f.read())
+
+    def test_login_failure(self):
+        """Test that metrics are written when logging in fails"""
+        with mock.patch('smtplib.SMTP', FakeSMTP), \
+                mock.patch.object(FakeSMTP, 'password', 'other'):
+            cli.send(self.args)
+        with open(self.summary) as f:
+            s = json.load(f)
+        self.assertEqual(s['messages'], {'sent': 0, 'failed': 0})
+        self.assertEqual(s['phase_seconds']['login']['count'], 1)
+        self.assertTrue(os.path.exists(self.prom))
+
+    def test_connect_failure(self):
+        """Test that metrics are written when the server can't be reached"""
+        def refuse(host, port=0, timeout=None):
+            raise ConnectionRefusedError(111, 'Connection refused')
+        with mock.patch('smtplib.SMTP', refuse):
+            cli.send(self.args)
+        with open(self.summary) as f:
+            s = json.load(f)
+        self.assertEqual(s['messages'], {'sent': 0, 'failed': 0})
+        self.assertEqual(s['phase_seconds']['connect']['count'], 1)
+        self.assertNotIn('login', s['phase_seconds'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import mock
+import sinterbot.sinterconf as config
+import sinterbot.serve as serve
+
+TESTDIR = 'test/'
+
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        shutil.copy(TESTDIR+'test.conf', self.path)
+        c = config.SinterConf.parse_and_validate(self.path)
+        c.save_derangement()
+        self.assignments = {s.email: r.email for s, r in c.get_assignments().items()}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def recipient(self, answer):
+        return answer['assignments'][0]['recipients'][0]['email']
+
+    def test_lookup(self):
+        lookup = serve.Lookup([self.path])
+        for email, recipient in self.assignments.items():
+            self.assertEqual(self.recipient(lookup.lookup(email)), recipient)
+        self.assertEqual(lookup.lookup('nobody@email.tld')['assignments'], [])
+
+    def test_reload(self):
+        """Test that the index is reloaded when the config changes"""
+        lookup = serve.Lookup([self.path], check_interval=0)
+        c = config.SinterConf.parse_and_validate(self.path)
+        c.derangement = [4, 2, 3, 0, 1]
+        c.save_derangement()
+        # make sure the mtime changes even on filesystems with coarse times
+        os.utime(self.path, ns=(0, lookup.indexes[0].mtime + 10**9))
+        self.assertEqual(self.recipient(lookup.lookup('user1@email.tld')), 'user5@email.tld')
+
+    def test_malformed_edit(self):
+        """Test that the previous assignments are kept if the config breaks"""
+        lookup = serve.Lookup([self.path], check_interval=0)
+        expected = self.assignments['user1@email.tld']
+        mtime = lookup.indexes[0].mtime
+        for line in ("\nmincycle: three", "\nderangement:[4, 2"):
+            with open(self.path, 'a') as f:
+                f.write(line)
+            mtime += 10**9
+            os.utime(self.path, ns=(0, mtime))
+            self.assertEqual(self.recipient(lookup.lookup('user1@email.tld')), expected)
+        # errors the parser does not anticipate are caught as well
+        os.utime(self.path, ns=(0, mtime + 10**9))
+        with mock.patch.object(config.SinterConf, 'parse_and_validate',
+                side_effect=ValueError("unexpected")):
+            self.assertEqual(self.recipient(lookup.lookup('user1@email.tld')), expected)
+
+    def test_http(self):
+        server = serve.HTTPServer(('127.0.0.1', 0), serve.Lookup([self.path]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection(*server.server_address)
+            for email, recipient in self.assignments.items():
+                conn.request('GET', '/lookup?email=' + email)
+                response = conn.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(self.recipient(json.loads(response.read())), recipient)
+            conn.request('GET', '/lookup?email=nobody@email.tld')
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 404)
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_socket(self):
+        path = os.path.join(self.tmpdir, 'sinterbot.sock')
+        server = serve.SocketServer(path, serve.Lookup([self.path]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            f = sock.makefile('rwb')
+            for email, recipient in self.assignments.items():
+                f.write(email.encode() + b"\n")
+                f.flush()
+                self.assertEqual(self.recipient(json.loads(f.readline())), recipient)
+            sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        serve.remove_socket(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_remove_socket(self):
+        """Test that a --socket path which is not a socket is left alone"""
+        with self.assertRaises(OSError):
+            serve.remove_socket(self.path)
+        self.assertTrue(os.path.exists(self.path))
+        serve.remove_socket(os.path.join(self.tmpdir, 'missing.sock'))
+
+
+if __name__ == '__main__':
+    unittest.main()